@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import html
+import time
+import random
+import urllib.request
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+ATOM_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" '
+               'xmlns:arxiv="http://arxiv.org/schemas/atom">\n'
+               '  <title type="html">ArXiv Query</title>\n'
+               '  <opensearch:totalResults>{total}</opensearch:totalResults>\n')
+ATOM_FOOTER = '</feed>\n'
+
+WORDS = ('portfolio optimization risk return volatility market asset allocation factor model estimation robust '
+         'covariance shrinkage momentum trading strategy transaction costs liquidity stochastic control reinforcement '
+         'learning neural network deep forecasting bayesian inference mean variance drawdown hedging').split()
+
+
+class Corpus:
+    """ A set of papers served by the stand-in arXiv server, either recorded from arXiv or synthetic. """
+    def __init__(self, listing: str, entries: Dict[str, str]):
+        """ Initialize the corpus.
+        Args:
+            listing (str): The HTML listing page.
+            entries (dict): Maps arXiv IDs (without version) to the XML of their Atom `<entry>` element.
+        """
+        self.listing = listing
+        self.entries = entries
+
+    @property
+    def ids(self) -> List[str]:
+        return list(self.entries.keys())
+
+    def atom(self, ids: List[str]) -> str:
+        """ Build the Atom response of an `id_list` query. Unknown IDs are skipped, like arXiv does. """
+        found = [self.entries[id] for id in ids if id in self.entries]
+        return ATOM_HEADER.format(total=len(found)) + ''.join(found) + ATOM_FOOTER
+
+    @classmethod
+    def synthetic(cls, n: int, category: str = 'q-fin.PM', yymm: str = '2401', seed: int = 0):
+        """ Generate a deterministic corpus of `n` papers in the formats of the arXiv listing page and Atom API.
+        Args:
+            n (int): The number of papers.
+            category (str): The primary category of the papers.
+            yymm (str): The month of the listing.
+            seed (int): The random seed.
+        Returns:
+            Corpus: The synthetic corpus.
+        """
+        rng = random.Random(seed)
+        items, entries = [], {}
+        for i in range(1, n + 1):
+            id = f"{yymm}.{i:05d}"
+            title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 12))).capitalize()
+            summary = '. '.join(' '.join(rng.choice(WORDS) for _ in range(rng.randint(10, 20))) for _ in range(8)) + '.'
+            authors = [f"Author {rng.randint(1, 5000)}" for _ in range(rng.randint(1, 5))]
+            author_links = ', \n'.join(f'<a href="/a/{a.replace(" ", "_")}">{a}</a>' for a in authors)
+            items.append(f'<dt><a name="item{i}">[{i}]</a>&nbsp;  <span class="list-identifier"><a href="/abs/{id}" '
+                         f'title="Abstract">arXiv:{id}</a> [<a href="/pdf/{id}" title="Download PDF">pdf</a>]</span></dt>\n'
+                         f'<dd>\n<div class="meta">\n<div class="list-title mathjax">\n'
+                         f'<span class="descriptor">Title:</span> {html.escape(title)}\n</div>\n'
+                         f'<div class="list-authors">\n<span class="descriptor">Authors:</span> \n{author_links}\n</div>\n'
+                         f'<div class="list-comments mathjax">\n<span class="descriptor">Comments:</span> {rng.randint(5, 40)} pages\n</div>\n'
+                         f'<div class="list-subjects">\n<span class="descriptor">Subjects:</span> <span class="primary-subject">{category}</span>\n</div>\n'
+                         f'</div>\n</dd>\n')
+            entries[id] = (f'  <entry>\n    <id>http://arxiv.org/abs/{id}v1</id>\n'
+                           f'    <updated>20{yymm[:2]}-{yymm[2:]}-01T00:00:00Z</updated>\n'
+                           f'    <published>20{yymm[:2]}-{yymm[2:]}-01T00:00:00Z</published>\n'
+                           f'    <title>{escape(title)}</title>\n    <summary>{escape(summary)}</summary>\n'
+                           + ''.join(f'    <author>\n      <name>{escape(a)}</name>\n    </author>\n' for a in authors) +
+                           f'    <link href="http://arxiv.org/abs/{id}v1" rel="alternate" type="text/html"/>\n'
+                           f'    <link title="pdf" href="http://arxiv.org/pdf/{id}v1" rel="related" type="application/pdf"/>\n'
+                           f'    <arxiv:primary_category xmlns:arxiv="http://arxiv.org/schemas/atom" term="{category}" scheme="http://arxiv.org/schemas/atom"/>\n'
+                           f'    <category term="{category}" scheme="http://arxiv.org/schemas/atom"/>\n  </entry>\n')
+
+        listing = (f'<!DOCTYPE html>\n<html><head><title>{category} authors/titles {yymm}</title></head><body>\n'
+                   f'<h3>Authors and titles for {yymm}</h3>\n<small>[ total of {n} entries: 1-{n} ]</small>\n'
+                   f'<dl>\n{"".join(items)}</dl>\n</body></html>\n')
+        return cls(listing, entries)
+
+    def save(self, directory: str) -> None:
+        """ Save the corpus as a recording (listing.html and entries.json). """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'listing.html'), 'w') as file:
+            file.write(self.listing)
+        with open(os.path.join(directory, 'entries.json'), 'w') as file:
+            json.dump(self.entries, file)
+
+    @classmethod
+    def load(cls, directory: str):
+        """ Load a corpus saved with `save` or recorded with `record`. """
+        with open(os.path.join(directory, 'listing.html'), 'r') as file:
+            listing = file.read()
+        with open(os.path.join(directory, 'entries.json'), 'r') as file:
+            entries = json.load(file)
+        return cls(listing, entries)
+
+    @classmethod
+    def record(cls, category: str, yymm: str, directory: Optional[str] = None, limit: int = 100):
+        """ Record a listing page and the Atom entries of its papers from the live arXiv API.
+        Args:
+            category (str): The category of the listing.
+            yymm (str): The month of the listing.
+            directory (str): If given, the recording is saved there.
+            limit (int): The maximum number of papers whose metadata is recorded.
+        Returns:
+            Corpus: The recorded corpus.
+        """
+        from bot.arxiv_api import ArxivFetcher, arxiv_base_url
+        from bot.resilience import request_timeout
+
+        base_url = arxiv_base_url()
+        listing = urllib.request.urlopen(f'{base_url}/list/{category}/{yymm}', timeout=request_timeout()).read().decode('utf-8')
+        ids = re.findall(r'arXiv:(\d+\.\d+)', listing)[:limit]
+        entries = {}
+        for i in range(0, len(ids), 10):
+            # the same pause between queries as the bot, as the arXiv API terms of use ask
+            time.sleep(ArxivFetcher.request_delay)
+            feed = urllib.request.urlopen(f"{base_url}/api/query?id_list={','.join(ids[i:i + 10])}",
+                                          timeout=request_timeout()).read().decode('utf-8')
+            for entry in re.findall(r'  <entry>.*?</entry>\n', feed, re.DOTALL):
+                id = re.sub(r'v\d+$', '', re.search(r'<id>http://arxiv.org/abs/([^<]+)</id>', entry).group(1))
+                entries[id] = entry
+        corpus = cls(listing, entries)
+        if directory:
+            corpus.save(directory)
+        return corpus
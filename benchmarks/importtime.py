@@ -0,0 +1,57 @@
+""" Check the cold-start import budget of the bot.
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter and fails if importing `main` takes longer than
+the budget or pulls in a heavy dependency that should only be imported on first use.
+
+Usage:
+    python -m benchmarks.importtime --budget-ms 150
+"""
+import re
+import sys
+import argparse
+import subprocess
+
+# dependencies that must not be imported by `import main`
+LAZY_MODULES = ('aiohttp', 'apscheduler', 'faiss', 'httpx', 'numpy', 'openai', 'opentelemetry', 'psycopg2', 'telegram')
+
+
+def measure(module: str = 'main') -> dict:
+    """ Import a module in a fresh interpreter and return the cumulative import time (in microseconds) of every
+    imported module.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)', line)
+        if match:
+            times[match.group(2)] = int(match.group(1))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the cold-start import budget of the bot.')
+    parser.add_argument('--module', default='main', help='The module to import.')
+    parser.add_argument('--budget-ms', type=float, default=150, help='The maximum cumulative import time in ms.')
+    args = parser.parse_args()
+
+    times = measure(args.module)
+    total_ms = times.get(args.module, 0) / 1000
+    eager = sorted(name for name in times if name.split('.')[0] in LAZY_MODULES)
+
+    print(f"import {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, microseconds in sorted(times.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {microseconds / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import time exceeds the budget of {args.budget_ms:.0f} ms")
+        failed = True
+    if eager:
+        print(f"FAIL: heavy dependencies imported eagerly: {', '.join(eager)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+""" Offline benchmarks of the bot pipeline.
+
+All external services are replaced by a local stand-in server (see `benchmarks/servers.py`) that replays recorded or
+synthetic arXiv responses and answers like OpenAI and Telegram, with a configurable latency.
+
+The parsers are also benchmarked on a small listing and its Atom entries recorded from arXiv
+(`benchmarks/recordings/q-fin.PM`), and checked to find every recorded paper.
+
+Usage:
+    python -m benchmarks.run --sizes 10 100 10000
+    python -m benchmarks.run --record benchmarks/recordings/q-fin.PM --category q-fin.PM --yymm 2401 --limit 25
+    python -m benchmarks.run --recording benchmarks/recordings/q-fin.PM --main
+"""
+import os
+import re
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import numpy as np
+
+from benchmarks.fixtures import Corpus
+from benchmarks.servers import StandInServer
+
+DEFAULT_RECORDING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings', 'q-fin.PM')
+
+
+def timed(function, *args, repeat: int = 1, **kwargs):
+    """ Run a function `repeat` times and return its last result and the best wall time in seconds. """
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def bench_parse(corpus: Corpus, repeat: int) -> dict:
+    """ Benchmark `ArxivFetcher.parse_arxiv_response_re` on the listing page. """
+    from bot.arxiv_api import ArxivFetcher
+
+    response = corpus.listing.encode('utf-8')
+    entries, seconds = timed(ArxivFetcher().parse_arxiv_response_re, response, repeat=repeat)
+    return {'benchmark': 'parse_arxiv_response_re', 'items': len(entries), 'seconds': seconds}
+
+
+def bench_parse_atom(corpus: Corpus, repeat: int) -> dict:
+    """ Benchmark `bot.atom.parse_atom` on a single Atom feed holding all papers of the corpus. """
+    from bot.atom import parse_atom
+
+    feed = corpus.atom(corpus.ids).encode('utf-8')
+    entries, seconds = timed(parse_atom, feed, repeat=repeat)
+    return {'benchmark': 'parse_atom', 'items': len(entries), 'seconds': seconds}
+
+
+def bench_recorded_parse(directory: str, repeat: int) -> list:
+    """ Benchmark the parsers on a recorded listing and Atom feed, and warn if they miss any recorded paper (e.g.
+    after a change of the arXiv markup).
+    """
+    if not os.path.isdir(directory):
+        logging.warning(f"No recording in {directory}: the parsers are only run on synthetic markup. "
+                        f"Record one with --record {directory}.")
+        return []
+    corpus = Corpus.load(directory)
+    results = [bench_parse(corpus, repeat), bench_parse_atom(corpus, repeat)]
+    expected = [len(set(re.findall(r'arXiv:(\d+\.\d+)', corpus.listing))), len(corpus.entries)]
+    for result, count in zip(results, expected):
+        result['size'] = 'recorded'
+        if result['items'] != count:
+            logging.warning(f"{result['benchmark']} found {result['items']} of the {count} recorded papers.")
+    return results
+
+
+def bench_fetch_metadata(corpus: Corpus, server: StandInServer) -> dict:
+    """ Benchmark `ArxivFetcher.fetch_metadata` against the stand-in arXiv API (without the polite delay). """
+    from bot.arxiv_api import ArxivFetcher
+
+    fetcher = ArxivFetcher()
+    fetcher.request_delay = 0
+    fetcher.parse_arxiv_response_re(corpus.listing.encode('utf-8'))
+    requests = server.requests['arxiv']
+    metadata, seconds = timed(fetcher.fetch_metadata)
+    return {'benchmark': 'fetch_metadata', 'items': len(metadata), 'seconds': seconds,
+            'requests': server.requests['arxiv'] - requests}
+
+
+def bench_faiss(n: int, dim: int, queries: int, k: int) -> list:
+    """ Benchmark `FaissDatabase.insert_data` and `FaissDatabase.search_cosine_knn` on random embeddings. """
+    from bot.embeddings import FaissDatabase
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((n, dim), dtype=np.float32)
+    data = [(f"2401.{i:05d}", f"title {i}", f"abstract {i}", embeddings[i].tolist()) for i in range(n)]
+
+    db = FaissDatabase(dim)
+    _, insert_seconds = timed(db.insert_data, data)
+
+    query_embeddings = rng.standard_normal((queries, dim), dtype=np.float32)
+    start = time.perf_counter()
+    for query in query_embeddings:
+        db.search_cosine_knn(query, k=min(k, n))
+    search_seconds = time.perf_counter() - start
+
+    return [{'benchmark': 'faiss_insert', 'items': n, 'seconds': insert_seconds},
+            {'benchmark': 'faiss_search', 'items': queries, 'seconds': search_seconds, 'index_size': n}]
+
+
+def bench_main(server: StandInServer, workdir: str) -> list:
+    """ Benchmark `main.main` end to end. Requires a PostgreSQL database configured with the usual environment
+    variables; the benchmark papers are inserted into POSTGRES_TABLE, so point it to a scratch table.
+    """
+    os.environ.update({
+        'ARXIV_BASE_URL': server.url,
+        'OPENAI_BASE_URL': f"{server.url}/v1",
+        'TELEGRAM_BASE_URL': f"{server.url}/bot",
+        'OPENAI_TOKEN': os.getenv('OPENAI_TOKEN', 'bench'),
+        'BOT_TOKEN': os.getenv('BOT_TOKEN', 'bench'),
+        'CHANNEL_ID': os.getenv('CHANNEL_ID', '@bench'),
+        'STATE_PATH': os.path.join(workdir, 'state.sqlite3'),
+        'METRICS_PATH': os.path.join(workdir, 'metrics.prom'),
+    })
+    os.environ.pop('CHANNELS_CONFIG', None)
+
+    import main
+    from bot.arxiv_api import ArxivFetcher
+    from bot.metrics import STAGE_DURATION, STAGE_ITEMS
+
+    main.POST_DELAY = 0
+    ArxivFetcher.request_delay = 0
+    STAGE_DURATION.values.clear()
+    STAGE_ITEMS.values.clear()
+
+    _, seconds = timed(main.main)
+    results = [{'benchmark': 'main', 'items': server.requests['telegram'], 'seconds': seconds}]
+    for (stage,), series in sorted(STAGE_DURATION.values.items()):
+        items = STAGE_ITEMS.values.get((stage,), series['count'])
+        results.append({'benchmark': f'main.{stage}', 'items': int(items), 'seconds': series['sum'], 'calls': series['count']})
+    return results
+
+
+def print_results(results: list) -> None:
+    """ Print the results as a table. """
+    print(f"{'benchmark':<28}{'size':>8}{'items':>8}{'seconds':>12}{'items/s':>14}")
+    for result in results:
+        rate = result['items'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+        print(f"{result['benchmark']:<28}{result.get('size', ''):>8}{result['items']:>8}{result['seconds']:>12.4f}{rate:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run offline benchmarks of the bot pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 10000], help='Numbers of synthetic papers.')
+    parser.add_argument('--recording', help='Replay a recorded corpus instead of synthetic ones.')
+    parser.add_argument('--parse-recording', default=DEFAULT_RECORDING, help='Recorded corpus the parsers are also run on.')
+    parser.add_argument('--record', metavar='DIR', help='Record a corpus from the live arXiv API into DIR and exit.')
+    parser.add_argument('--limit', type=int, default=25, help='Papers whose metadata is recorded.')
+    parser.add_argument('--category', default='q-fin.PM', help='Category of the recorded or synthetic listings.')
+    parser.add_argument('--yymm', default='2401', help='Month of the recorded or synthetic listings.')
+    parser.add_argument('--arxiv-latency', type=float, default=0.0, help='Latency of the stand-in arXiv API in seconds.')
+    parser.add_argument('--openai-latency', type=float, default=0.0, help='Latency of the stand-in OpenAI API in seconds.')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='Latency of the stand-in Telegram API in seconds.')
+    parser.add_argument('--embedding-dim', type=int, default=1536, help='Embedding dimension.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of kNN queries in the Faiss benchmark.')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions of the CPU-bound benchmarks (best is kept).')
+    parser.add_argument('--main', action='store_true', help='Also benchmark main.main end to end (needs PostgreSQL).')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['parse', 'metadata', 'faiss'], help='Benchmarks to skip.')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.record:
+        corpus = Corpus.record(args.category, args.yymm, args.record, args.limit)
+        print(f"Recorded {len(corpus.entries)} papers into {args.record}")
+        return
+
+    if args.recording:
+        corpora = [Corpus.load(args.recording)]
+    else:
+        corpora = [Corpus.synthetic(n, args.category, args.yymm) for n in args.sizes]
+
+    latency = {'arxiv': args.arxiv_latency, 'openai': args.openai_latency, 'telegram': args.telegram_latency}
+    results = []
+    if 'parse' not in args.skip and not args.recording:
+        results += bench_recorded_parse(args.parse_recording, args.repeat)
+    for corpus in corpora:
+        size = len(corpus.entries)
+        with StandInServer(corpus, latency, args.embedding_dim) as server, tempfile.TemporaryDirectory() as workdir:
+            os.environ['ARXIV_BASE_URL'] = server.url
+            size_results = []
+            if 'parse' not in args.skip:
+                size_results.append(bench_parse(corpus, args.repeat))
+                size_results.append(bench_parse_atom(corpus, args.repeat))
+            if 'metadata' not in args.skip:
+                size_results.append(bench_fetch_metadata(corpus, server))
+            if 'faiss' not in args.skip:
+                size_results += bench_faiss(size, args.embedding_dim, args.queries, k=5)
+            if args.main:
+                size_results += bench_main(server, workdir)
+            for result in size_results:
+                result['size'] = size
+            results += size_results
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print_results(results)
+    print(f"peak RSS: {peak_rss_mb:.1f} MB")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'results': results, 'peak_rss_mb': peak_rss_mb}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
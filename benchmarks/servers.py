@@ -0,0 +1,142 @@
+import json
+import time
+import zlib
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.fixtures import Corpus
+
+
+class StandInServer:
+    """ A local HTTP server standing in for arXiv, OpenAI and Telegram, with configurable latency per service.
+
+    Routes:
+        GET  /list/<category>/<yymm>   arXiv listing page
+        GET  /api/query?id_list=...    arXiv Atom API
+        POST /v1/chat/completions      OpenAI chat completions
+        POST /v1/embeddings            OpenAI embeddings
+        POST /bot<token>/<method>      Telegram Bot API (getMe, sendMessage, ...)
+    """
+    def __init__(self, corpus: Corpus, latency: Optional[Dict[str, float]] = None, embedding_dim: int = 1536,
+                 host: str = '127.0.0.1', port: int = 0):
+        """ Initialize the server (call `start` to serve).
+        Args:
+            corpus (Corpus): The papers served as arXiv responses.
+            latency (dict): Seconds of latency added to each response, per service ('arxiv', 'openai', 'telegram').
+            embedding_dim (int): The dimension of the returned embeddings.
+            host (str): The interface to listen on.
+            port (int): The port to listen on (0 picks a free port).
+        """
+        self.corpus = corpus
+        self.latency = latency or {}
+        self.embedding_dim = embedding_dim
+        self.requests = {'arxiv': 0, 'openai': 0, 'telegram': 0}
+        self.lock = threading.Lock()
+        self.message_id = 0
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def embedding(self, text: str) -> list:
+        """ A deterministic pseudo-random embedding of a text. """
+        rng = random.Random(zlib.crc32(text.encode('utf-8')))
+        return [rng.uniform(-1, 1) for _ in range(self.embedding_dim)]
+
+    def handle(self, method: str, path: str, body: bytes):
+        """ Compute the response of a request.
+        Returns:
+            tuple: The service name, the content type and the response body.
+        """
+        url = urlparse(path)
+        parts = [part for part in url.path.split('/') if part]
+
+        if method == 'GET' and parts[:1] == ['list']:
+            return 'arxiv', 'text/html; charset=utf-8', self.corpus.listing.encode('utf-8')
+
+        if method == 'GET' and parts[:2] == ['api', 'query']:
+            ids = [id for id in parse_qs(url.query).get('id_list', [''])[0].split(',') if id]
+            return 'arxiv', 'application/atom+xml; charset=utf-8', self.corpus.atom(ids).encode('utf-8')
+
+        if parts[:1] == ['v1']:
+            request = json.loads(body or b'{}')
+            if parts[1:] == ['chat', 'completions']:
+                content = ' '.join(request['messages'][-1]['content'].split()[-40:])
+                response = {'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()),
+                            'model': request.get('model'),
+                            'choices': [{'index': 0, 'finish_reason': 'stop',
+                                         'message': {'role': 'assistant', 'content': content}}],
+                            'usage': {'prompt_tokens': 200, 'completion_tokens': 40, 'total_tokens': 240}}
+            else:
+                texts = request['input'] if isinstance(request['input'], list) else [request['input']]
+                response = {'object': 'list', 'model': request.get('model'),
+                            'data': [{'object': 'embedding', 'index': i, 'embedding': self.embedding(text)}
+                                     for i, text in enumerate(texts)],
+                            'usage': {'prompt_tokens': 200 * len(texts), 'total_tokens': 200 * len(texts)}}
+            return 'openai', 'application/json', json.dumps(response).encode('utf-8')
+
+        if parts and parts[0].startswith('bot'):
+            telegram_method = parts[-1]
+            if telegram_method == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+            else:
+                with self.lock:
+                    self.message_id += 1
+                    message_id = self.message_id
+                result = {'message_id': message_id, 'date': int(time.time()),
+                          'chat': {'id': -1000000000001, 'type': 'channel', 'title': 'bench'}, 'text': ''}
+            return 'telegram', 'application/json', json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+        return None, None, None
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, method):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                service, content_type, payload = server.handle(method, self.path, body)
+                if service is None:
+                    self.send_error(404)
+                    return
+                with server.lock:
+                    server.requests[service] += 1
+                time.sleep(server.latency.get(service, 0))
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
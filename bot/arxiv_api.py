@@ -1,3 +1,4 @@
+import os
 import re
 import json
 import time
@@ -5,12 +6,36 @@ import html
 import logging
 import urllib
 import urllib.request
-import feedparser
 
 from datetime import datetime
 
+from bot.atom import iter_atom_entries
+from bot.metrics import BYTES_RECEIVED, api_call
+from bot.resilience import call_with_retry, request_timeout
+
+# base URL of the arXiv export service; ARXIV_BASE_URL can point it to a local stand-in (see benchmarks/)
+DEFAULT_ARXIV_BASE_URL = 'http://export.arxiv.org'
+
+def arxiv_base_url() -> str:
+  """ Return the base URL of the arXiv export service. """
+  return os.getenv('ARXIV_BASE_URL', DEFAULT_ARXIV_BASE_URL).rstrip('/')
+
+class CountingReader:
+    """ Wraps a binary file-like object and counts the bytes read from it. """
+    def __init__(self, raw):
+      self.raw = raw
+      self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+      data = self.raw.read(size)
+      self.bytes_read += len(data)
+      return data
+
 class ArxivFetcher:
     """ A class to fetch articles metadata using arXiv API. """
+    # seconds to wait between two consecutive metadata queries (arXiv asks clients to throttle)
+    request_delay = 5
+
     def __init__(self, category: str='q-fin.PM', date: str=""):
       """ Initialize the ArxivFetcher with a default category and date.
       Args:
@@ -54,9 +79,13 @@ class ArxivFetcher:
         >>> fetcher = ArxivFetcher(category='q-fin.PM')
         >>> print_response(response)
       """
-      url = f'http://export.arxiv.org//list/{self.category}/{self.date}'
+      url = f'{arxiv_base_url()}//list/{self.category}/{self.date}'
       logging.info(url)
-      response = urllib.request.urlopen(url).read()
+      def fetch() -> bytes:
+        with api_call('arxiv', 'list', category=self.category):
+          return urllib.request.urlopen(url, timeout=request_timeout()).read()
+      response = call_with_retry('arxiv', 'list', fetch)
+      BYTES_RECEIVED.inc(len(response), service='arxiv')
       return response
 
     @staticmethod
@@ -112,7 +141,7 @@ class ArxivFetcher:
       results = {}
       for i, id in enumerate(ids):
         if id is not None:
-          results[id] = {'title': titles[i], 'authors': authors[i], 'pdf_export_link': f'http://export.arxiv.org/pdf/{id}'}
+          results[id] = {'title': titles[i], 'authors': authors[i], 'pdf_export_link': f'{arxiv_base_url()}/pdf/{id}'}
 
       if results:
         logging.info(f"{len(ids)} articles found: {ids}\n")
@@ -124,22 +153,50 @@ class ArxivFetcher:
       return results
 
     def save_to_json(self, filepath: str) -> None:
-      """ Save the current state of the object to a JSON file.
+      """ Save the current state of the object to a JSON file. The file is written to a temporary file first and then
+      renamed, so that a crash never leaves a truncated state file behind.
       Args:
           filepath (str): The file path where the object's state will be saved.
       Example:
           >>> fetcher = ArxivFetcher(category='q-fin.PM')
           >>> fetcher.save_to_json('fetcher.json')
       """
-      with open(filepath, 'w') as file:
+      tmp_filepath = f"{filepath}.tmp"
+      with open(tmp_filepath, 'w') as file:
           json.dump({
               'category': self.category,
               'date': self.date,
               'entries': self.entries,
               'ids': self.ids
-          }, file)
+          }, file, separators=(',', ':'))
+          file.flush()
+          os.fsync(file.fileno())
+      os.replace(tmp_filepath, filepath)
       logging.info(f"ArxivFetcher state saved to {filepath}")
 
+    def save_to_store(self, store) -> list:
+      """ Record the parsed entries in a state store (see `bot.state.StateStore`). Only new entries are written.
+      Args:
+          store (StateStore): The state store.
+      Returns:
+          list: IDs of the entries that were not tracked before.
+      Example:
+          >>> fetcher.save_to_store(StateStore())
+      """
+      return store.record_entries(self.category, self.entries)
+
+    def keep_pending(self, store) -> list:
+      """ Drop the entries that have already been processed according to a state store.
+      Args:
+          store (StateStore): The state store.
+      Returns:
+          list: IDs of the remaining (pending) entries.
+      """
+      self.ids = store.pending_ids(self.ids)
+      self.entries = {id: self.entries[id] for id in self.ids}
+      logging.info(f"{len(self.ids)} entries have not been processed yet.")
+      return self.ids
+
     @classmethod
     def load_from_json(cls, filepath: str):
       """ Load the state of the object from a JSON file.     
@@ -172,28 +229,38 @@ class ArxivFetcher:
         yield self.ids[i:i + group_size]
 
     @staticmethod
-    def query_arxiv(ids) -> bytes:
+    def query_arxiv(ids) -> list:
       """ Query arXiv API to get metadata of articles with certain IDs.
       Args:
         ids: A single ID as a string or a list of IDs to be queried.
       Returns:
-        bytes: The raw response from the arXiv API, containing the metadata of the article(s) with the specified ID(s).
-             This is returned as a byte string.
+        list of dicts: The Atom entries of the article(s) with the specified ID(s) (see `bot.atom.parse_entry`).
+      """
+      return list(ArxivFetcher.iter_query_arxiv(ids))
+
+    @staticmethod
+    def iter_query_arxiv(ids):
+      """ Query arXiv API to get metadata of articles with certain IDs, parsing the Atom response while it is being
+      downloaded. Memory stays bounded by the size of one entry, which makes large backfill queries affordable.
+      Args:
+        ids: A single ID as a string or a list of IDs to be queried.
+      Yields:
+        dict: The Atom entry of an article (see `bot.atom.parse_entry`).
       """
       if isinstance(ids, str):
         ids = [ids]
 
       joined_ids = ','.join(ids)
-      query = f"http://export.arxiv.org/api/query?id_list={joined_ids}"
+      query = f"{arxiv_base_url()}/api/query?id_list={joined_ids}&max_results={len(ids)}"
       logging.info(f'Query: {query}')
 
-      r = urllib.request.urlopen(query)
-
-      feedparser.mixin._FeedParserMixin.namespaces['http://a9.com/-/spec/opensearch/1.1/'] = 'opensearch'
-      feedparser.mixin._FeedParserMixin.namespaces['http://arxiv.org/schemas/atom'] = 'arxiv'
-
-      feed = feedparser.parse(r)
-      return feed.entries
+      with api_call('arxiv', 'query', ids=len(ids)):
+        with urllib.request.urlopen(query, timeout=request_timeout()) as response:
+          reader = CountingReader(response)
+          try:
+            yield from iter_atom_entries(reader)
+          finally:
+            BYTES_RECEIVED.inc(reader.bytes_read, service='arxiv')
 
     @staticmethod
     def remove_after_keywords(text: str) -> str:
@@ -210,29 +277,59 @@ class ArxivFetcher:
       else:
         return text 
         
+    @staticmethod
+    def parse_arxiv_id(link: str) -> str:
+      """ Extract the arXiv ID without its version from an abstract link.
+      Args:
+        link: The abstract link, e.g. 'http://arxiv.org/abs/2401.01234v2'.
+      Returns:
+        str: The arXiv ID, e.g. '2401.01234'.
+      """
+      arxiv_id = link.rstrip('/').rsplit('/abs/', 1)[-1]
+      return re.sub(r'v\d+$', '', arxiv_id)
+
+    def iter_metadata_groups(self):
+      """ Fetch metadata for groups of article IDs, one API call per group.
+      A group that still fails after retries is logged and skipped, so its articles are left for the next run.
+      Yields:
+        list: The raw metadata items of one group, as soon as the group has been fetched.
+      """
+      for i, id_group in enumerate(self.split_list_into_groups()):
+        if i > 0:
+          time.sleep(self.request_delay)  # Wait before the next API call
+        logging.info(f"Fetching metadata for IDs: {id_group}")
+        try:
+          group = call_with_retry('arxiv', 'query', lambda: self.query_arxiv(id_group))
+        except Exception as e:
+          logging.error(f"Failed to fetch metadata for IDs {id_group}: {e}")
+          continue
+        yield group
+
     def fetch_metadata_groups(self) -> list:
       """ Fetch metadata for groups of article IDs.
       Returns:
         list of dicts: Metadata of the articles with the specified IDs.
       """
       metadata = []
-      id_groups = self.split_list_into_groups()
-      for id_group in id_groups:
-        logging.info(f"Fetching metadata for IDs: {id_group}")
-        metadata += self.query_arxiv(id_group)
-        time.sleep(5)  # Wait for 5 seconds before the next API call
+      for group in self.iter_metadata_groups():
+        metadata += group
       return metadata
 
-    def process_metadata_item(self, item, id_index):
-      """ Process a single metadata item.
+    def process_metadata_item(self, item):
+      """ Process a single metadata item. The item is joined with the listing entry by its arXiv ID, so the
+      order of the items returned by the API does not matter. The method only reads `self.entries`, so
+      batches can safely be processed concurrently.
       Args:
         item: The metadata item to process.
-        id_index: The index of the corresponding ID in self.ids.
       Returns:
-        dict: Processed metadata item.
+        dict: Processed metadata item, or None if the item does not belong to any listing entry.
       """
-      id = self.ids[id_index]
-      entry = self.entries[id]
+      id = self.parse_arxiv_id(item['id'])
+      entry = self.entries.get(id)
+      if entry is None:
+        logging.warning(f"Metadata item {item['id']} does not match any listing entry.")
+        return None
+
       return {
           "id": id,
           "abstract_link": item['id'],
@@ -245,6 +342,31 @@ class ArxivFetcher:
           "arxiv_comment": "",
           "arxiv_primary_category": item['arxiv_primary_category']['term']}
 
+    def iter_metadata(self):
+      """ Fetch and process metadata for a list of article IDs, streaming the records of each group as soon as it
+      has been fetched.
+      Yields:
+        dict: Metadata of an article.
+      Example:
+        >>> fetcher = ArxivFetcher(category='q-fin.PM')
+        >>> for record in fetcher.iter_metadata():
+        ...     print(record['title'])
+      """
+      if not self.ids:
+        logging.warning("No article IDs found.")
+        return
+
+      missing = set(self.ids)
+      for group in self.iter_metadata_groups():
+        for item in group:
+          record = self.process_metadata_item(item)
+          if record is not None and record['id'] in missing:
+            missing.discard(record['id'])
+            yield record
+
+      if missing:
+        logging.warning(f"No metadata returned for {len(missing)} articles: {sorted(missing)}")
+
     def fetch_metadata(self):
       """ Fetch metadata for a list of article IDs.
       Returns:
@@ -253,14 +375,6 @@ class ArxivFetcher:
         >>> fetcher = ArxivFetcher(category='q-fin.PM')
         >>> metadata = fetcher.fetch_metadata()
       """
-      metadata = []
-      if not self.ids:
-        logging.warning("No article IDs found.")
-        return metadata
-
-      fetched_metadata = self.fetch_metadata_groups()
-      logging.info(f"Fetched metadata of {len(fetched_metadata)} articles.")
-
-      processed_data = [self.process_metadata_item(item, i) for i, item in enumerate(fetched_metadata)]
+      processed_data = list(self.iter_metadata())
       logging.info(f"Processed metadata of {len(processed_data)} articles.")
-      return processed_data
\ No newline at end of file
+      return processed_data
@@ -0,0 +1,69 @@
+import io
+import logging
+import xml.etree.ElementTree as ET
+from typing import Iterator, Union
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+ARXIV = '{http://arxiv.org/schemas/atom}'
+
+
+def _text(entry: ET.Element, tag: str) -> str:
+    """ Return the stripped text of a child element, or an empty string. """
+    element = entry.find(tag)
+    return element.text.strip() if element is not None and element.text else ''
+
+
+def parse_entry(entry: ET.Element) -> dict:
+    """ Extract the fields of an Atom `<entry>` element that the bot uses.
+    The result has the same keys as a feedparser entry, so it can be passed to `ArxivFetcher.process_metadata_item`.
+    Args:
+        entry (Element): The `<entry>` element.
+    Returns:
+        dict: The entry fields.
+    """
+    primary_category = entry.find(f'{ARXIV}primary_category')
+    return {
+        'id': _text(entry, f'{ATOM}id'),
+        'updated': _text(entry, f'{ATOM}updated'),
+        'published': _text(entry, f'{ATOM}published'),
+        'title': _text(entry, f'{ATOM}title'),
+        'summary': _text(entry, f'{ATOM}summary'),
+        'authors': [_text(author, f'{ATOM}name') for author in entry.iterfind(f'{ATOM}author')],
+        'arxiv_comment': _text(entry, f'{ARXIV}comment'),
+        'arxiv_primary_category': {'term': primary_category.get('term', '') if primary_category is not None else ''},
+    }
+
+
+def iter_atom_entries(source: Union[bytes, io.IOBase]) -> Iterator[dict]:
+    """ Incrementally parse an arXiv Atom feed and yield its entries one by one.
+
+    Every `<entry>` element is discarded as soon as it has been converted, so memory stays bounded by the size of a
+    single entry however large the feed is.
+    Args:
+        source: The feed, either as bytes or as a binary file-like object (e.g. an HTTP response).
+    Yields:
+        dict: The fields of an entry (see `parse_entry`).
+    Example:
+        >>> with urllib.request.urlopen(query) as response:
+        ...     for entry in iter_atom_entries(response):
+        ...         print(entry['id'])
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+
+    root = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        if element.tag == f'{ATOM}entry':
+            yield parse_entry(element)
+            root.remove(element)
+
+
+def parse_atom(source: Union[bytes, io.IOBase]) -> list:
+    """ Parse an arXiv Atom feed into a list of entries (see `iter_atom_entries`). """
+    entries = list(iter_atom_entries(source))
+    logging.info(f"Parsed {len(entries)} Atom entries.")
+    return entries
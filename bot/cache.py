@@ -0,0 +1,59 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from bot.metrics import CACHE_LOOKUPS
+
+_MISSING = object()
+
+
+class LRUCache:
+    """ A thread-safe least-recently-used cache holding at most `maxsize` entries, optionally for at most `ttl` seconds.
+    Example:
+        >>> cache = LRUCache(maxsize=2, ttl=60, name='results')
+        >>> cache.put('a', 1)
+        >>> cache.get('a')
+        1
+    """
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, name: str = 'cache'):
+        """
+        Args:
+            maxsize (int): The maximum number of entries; the least recently used entry is evicted first.
+            ttl (float): The number of seconds an entry stays valid, or None to keep entries until they are evicted.
+            name (str): The label of the cache in the `CACHE_LOOKUPS` metric.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return the value cached for a key (and mark it as recently used), or `default`. """
+        with self.lock:
+            value, expires = self.entries.get(key, (_MISSING, None))
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                value = _MISSING
+            elif value is not _MISSING:
+                self.entries.move_to_end(key)
+        CACHE_LOOKUPS.inc(cache=self.name, result='miss' if value is _MISSING else 'hit')
+        return default if value is _MISSING else value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """ Cache a value, evicting the least recently used entry if the cache is full. """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """ Remove all entries. """
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,214 @@
+""" Interactive bot commands answered from the article database and the vector index.
+
+Usage:
+    python -m bot.commands --index-dir faiss_db                  # long polling
+    WEBHOOK_SECRET=... python -m bot.commands --webhook-url https://example.org/bot  # webhook
+
+Commands:
+    /search <text>          semantic search over the abstracts
+    /similar <arxiv id>     articles similar to an indexed article
+    /latest <category>      the most recent articles of a category (e.g. q-fin.PM)
+
+The commands run in their own process, so they never block the posting pipeline of `main.py`.
+"""
+import os
+import html
+import time
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+from bot.cache import LRUCache
+from bot.metrics import REQUEST_DURATION
+from bot.search import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, SearchEngine, create_engine
+
+DEFAULT_RESULTS = 5
+# number of updates handled at the same time
+DEFAULT_CONCURRENT_UPDATES = 256
+MAX_QUERY_LENGTH = 300
+
+HELP = ("/search <text> - articles about a topic\n"
+        "/similar <arxiv id> - articles similar to an article\n"
+        "/latest <category> - the most recent articles of a category (e.g. q-fin.PM)")
+
+
+class RateLimiter:
+    """ A token bucket per user: a user can send `burst` commands at once, refilled at `rate` commands per second.
+    Only the `max_users` most recently seen users are tracked, so memory stays bounded.
+    """
+    def __init__(self, rate: float = 0.5, burst: int = 5, max_users: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        """ Take a token from the bucket of a user. Returns False if the user has to wait. """
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > self.max_users:
+            self.buckets.popitem(last=False)
+        return allowed
+
+
+def format_results(results: List[dict], empty: str) -> str:
+    """ Format articles as an HTML message, one numbered line per article. """
+    if not results:
+        return empty
+    lines = []
+    for i, article in enumerate(results, 1):
+        link = article.get('abstract_link') or f"https://arxiv.org/abs/{article['id']}"
+        details = [article['published'][:10]] if article.get('published') else []
+        if 'score' in article:
+            details.append(f"similarity {article['score']:.2f}")
+        suffix = f" ({', '.join(details)})" if details else ''
+        title = ' '.join((article.get('title') or article['id']).split())
+        lines.append(f"{i}. <a href=\"{html.escape(link)}\">{html.escape(title)}</a>{suffix}")
+    return '\n'.join(lines)
+
+
+class CommandHandlers:
+    """ The handlers of the bot commands. Answers are cached by command and argument, on top of the result cache of
+    the search engine, and every user is rate limited.
+    """
+    def __init__(self, engine: SearchEngine, limiter: Optional[RateLimiter] = None, k: int = DEFAULT_RESULTS,
+                 cache_size: int = DEFAULT_CACHE_SIZE, cache_ttl: float = DEFAULT_CACHE_TTL):
+        self.engine = engine
+        self.limiter = limiter or RateLimiter()
+        self.k = k
+        self.responses = LRUCache(cache_size, ttl=cache_ttl, name='responses')
+
+    async def help(self, update, context) -> None:
+        await update.effective_message.reply_text(HELP)
+
+    async def search(self, update, context) -> None:
+        async def answer(query: str) -> str:
+            return format_results(await self.engine.search(query, self.k), "No articles found.")
+        await self._answer(update, context, 'search', answer, usage="/search <text>")
+
+    async def similar(self, update, context) -> None:
+        async def answer(arxiv_id: str) -> str:
+            try:
+                return format_results(await self.engine.similar(arxiv_id, self.k), "No similar articles found.")
+            except KeyError:
+                return f"{html.escape(arxiv_id)} is not in the index."
+        await self._answer(update, context, 'similar', answer, usage="/similar <arxiv id>")
+
+    async def latest(self, update, context) -> None:
+        async def answer(category: str) -> str:
+            if self.engine.pool is None:
+                return "Latest articles are not available."
+            return format_results(await self.engine.filter(category=category, limit=self.k),
+                                  f"No articles found in {html.escape(category)}.")
+        await self._answer(update, context, 'latest', answer, usage="/latest <category>")
+
+    async def _answer(self, update, context, command: str, answer: Callable[[str], Awaitable[str]], usage: str) -> None:
+        """ Rate limit the user, then reply with the cached or computed answer to the command argument. """
+        from telegram.constants import ParseMode
+
+        start = time.perf_counter()
+        message = update.effective_message
+        try:
+            argument = ' '.join(context.args or [])[:MAX_QUERY_LENGTH]
+            if not argument:
+                await message.reply_text(f"Usage: {usage}")
+                return
+            user = update.effective_user
+            if user is not None and not self.limiter.allow(user.id):
+                await message.reply_text("Too many requests, please try again in a few seconds.")
+                return
+
+            # keyed on the exact argument, since the answers can depend on its case (e.g. categories)
+            key = (command, argument)
+            text = self.responses.get(key)
+            if text is None:
+                text = await answer(argument)
+                self.responses.put(key, text)
+            await message.reply_text(text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - start, endpoint=f'/{command}')
+
+
+async def on_error(update, context) -> None:
+    """ Log errors of the handlers instead of stopping the bot. """
+    logging.error(f"An error occurred while handling an update: {context.error}")
+
+
+def build_application(engine: SearchEngine, token: Optional[str] = None, concurrent_updates: int = DEFAULT_CONCURRENT_UPDATES,
+                      limiter: Optional[RateLimiter] = None):
+    """ Build the python-telegram-bot application that answers the commands.
+    Updates are handled concurrently, so a slow query of one user never delays the answers to the others.
+    Args:
+        engine (SearchEngine): The engine that answers the queries.
+        token (str): The bot token. Defaults to the `BOT_TOKEN` environment variable.
+        concurrent_updates (int): The number of updates handled at the same time.
+        limiter (RateLimiter): The per-user rate limiter.
+    Returns:
+        telegram.ext.Application: The application.
+    """
+    from telegram.ext import Application, CommandHandler
+
+    handlers = CommandHandlers(engine, limiter)
+    application = (Application.builder()
+                   .token(token or os.getenv('BOT_TOKEN'))
+                   .base_url(os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot'))
+                   .concurrent_updates(concurrent_updates)
+                   .build())
+    application.add_handler(CommandHandler(['start', 'help'], handlers.help))
+    application.add_handler(CommandHandler('search', handlers.search))
+    application.add_handler(CommandHandler('similar', handlers.similar))
+    application.add_handler(CommandHandler('latest', handlers.latest))
+    application.add_error_handler(on_error)
+    return application
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    from bot.embeddings import DEFAULT_EMBEDDING_DIM, DEFAULT_INDEX_DIR
+
+    parser = argparse.ArgumentParser(description='Answer /search, /similar and /latest commands.')
+    parser.add_argument('--index-dir', default=os.getenv('FAISS_INDEX_DIR', DEFAULT_INDEX_DIR), help='Directory of index.faiss and metadata.pkl.')
+    parser.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help='Embedding dimension.')
+    parser.add_argument('--no-database', action='store_true', help='Answer from the index only (no /latest).')
+    parser.add_argument('--pool-size', type=int, default=10, help='Maximum number of database connections.')
+    parser.add_argument('--concurrent-updates', type=int, default=DEFAULT_CONCURRENT_UPDATES, help='Updates handled at the same time.')
+    parser.add_argument('--rate', type=float, default=0.5, help='Commands per second and user.')
+    parser.add_argument('--burst', type=int, default=5, help='Commands a user can send at once.')
+    parser.add_argument('--webhook-url', help='Receive updates on this public URL instead of long polling.')
+    parser.add_argument('--webhook-secret', default=os.getenv('WEBHOOK_SECRET'),
+                        help='Secret token Telegram sends with every webhook update (required with --webhook-url).')
+    parser.add_argument('--listen', default='0.0.0.0', help='The interface the webhook listens on.')
+    parser.add_argument('--port', type=int, default=8443, help='The port the webhook listens on.')
+    args = parser.parse_args(argv)
+    # without the secret, anyone who finds the URL could post fake updates to the bot
+    if args.webhook_url and not args.webhook_secret:
+        parser.error("--webhook-url requires --webhook-secret (or WEBHOOK_SECRET).")
+    return args
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from dotenv import load_dotenv
+    from urllib.parse import urlparse
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s')
+    args = parse_args(argv)
+    engine = create_engine(args.index_dir, args.dim, not args.no_database, args.pool_size)
+    application = build_application(engine, concurrent_updates=args.concurrent_updates,
+                                    limiter=RateLimiter(args.rate, args.burst))
+    try:
+        if args.webhook_url:
+            application.run_webhook(listen=args.listen, port=args.port, url_path=urlparse(args.webhook_url).path.lstrip('/'),
+                                    webhook_url=args.webhook_url, secret_token=args.webhook_secret)
+        else:
+            application.run_polling()
+    finally:
+        if engine.pool is not None:
+            engine.pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,52 @@
 import os
+import itertools
 import logging
 import psycopg2
 from psycopg2 import sql
-from typing import Optional, List, Tuple
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, List, Sequence, Tuple
 
 import psycopg2
 from psycopg2 import sql
 import logging
 
+from bot.metrics import api_call
+
+# key of the advisory lock that prevents overlapping pipeline runs
+ADVISORY_LOCK_KEY = 0x61727869
+
+# columns used to build the embeddings of the articles
+DEFAULT_COLUMNS = ('id', 'title', 'summary')
+
+# server-side cursors need unique names within a connection
+_cursor_ids = itertools.count()
+
+# columns returned by the query services (the abstract is left out to keep the responses small)
+ARTICLE_COLUMNS = ('id', 'title', 'authors', 'published', 'abstract_link', 'arxiv_primary_category')
+
+# environment variables with the connection details of the database
+REQUIRED_ENV_VARS = ('POSTGRES_DB', 'POSTGRES_USERNAME', 'POSTGRES_PASSWORD', 'POSTGRES_HOST', 'POSTGRES_PORT', 'POSTGRES_TABLE')
+
+
+def check_env_variables() -> bool:
+    """ Checks if the environment variables with the connection details of the database are set. """
+    all_vars_present = True
+    for var in REQUIRED_ENV_VARS:
+        if not os.getenv(var):
+            logging.error(f"Environment variable {var} is not set.")
+            all_vars_present = False
+    return all_vars_present
+
+
+def connection_params() -> dict:
+    """ The connection details of the database, from the environment. """
+    return dict(host=os.getenv('POSTGRES_HOST'),
+                port=os.getenv('POSTGRES_PORT'),
+                database=os.getenv('POSTGRES_DB'),
+                user=os.getenv('POSTGRES_USERNAME'),
+                password=os.getenv('POSTGRES_PASSWORD'))
+
+
 class PostgresHandler:
     """ A class for interacting with a PostgreSQL database. """
     def __init__(self, database="postgres", user="postgres", password="", host='localhost', port=5432, table_name="arxiv_articles"):
@@ -23,27 +62,13 @@ class PostgresHandler:
 
     def check_env_variables(self):
         """ Checks if required environment variables are set. """
-        required_env_vars = ['POSTGRES_DB', 'POSTGRES_USERNAME', 'POSTGRES_PASSWORD', 'POSTGRES_HOST', 'POSTGRES_PORT', 'POSTGRES_TABLE']
-        all_vars_present = True
-
-        for var in required_env_vars:
-            if not os.getenv(var):
-                logging.error(f"Environment variable {var} is not set.")
-                all_vars_present = False
-
-        return all_vars_present
+        return check_env_variables()
 
     def connect_to_postgres(self):
         """ Connects to a PostgreSQL database and returns the connection and cursor objects.
         """
         try:
-            conn = psycopg2.connect(
-                host=os.getenv('POSTGRES_HOST'),
-                port=os.getenv('POSTGRES_PORT'),
-                database=os.getenv('POSTGRES_DB'),
-                user=os.getenv('POSTGRES_USERNAME'),
-                password=os.getenv('POSTGRES_PASSWORD')
-            )
+            conn = psycopg2.connect(**connection_params())
             cursor = conn.cursor()
             logging.info("Connected to the database successfully")
             return conn, cursor
@@ -61,6 +86,24 @@ class PostgresHandler:
             self.conn.close()
             logging.info("Database connection closed.")
 
+    def try_advisory_lock(self, key: int = ADVISORY_LOCK_KEY) -> bool:
+        """ Try to acquire a session-level PostgreSQL advisory lock without waiting.
+        The lock is released with `release_advisory_lock` or automatically when the connection is closed.
+        Args:
+            key (int): The advisory lock key shared by all bot processes.
+        Returns:
+            bool: True if the lock has been acquired, False if another session holds it.
+        """
+        self.cursor.execute("SELECT pg_try_advisory_lock(%s)", (key,))
+        acquired = self.cursor.fetchone()[0]
+        self.conn.commit()
+        return acquired
+
+    def release_advisory_lock(self, key: int = ADVISORY_LOCK_KEY) -> None:
+        """ Release a session-level PostgreSQL advisory lock acquired with `try_advisory_lock`. """
+        self.cursor.execute("SELECT pg_advisory_unlock(%s)", (key,))
+        self.conn.commit()
+
     def get_ids_not_in_database(self, input_ids: List[str], batch_size:int=1000) -> List[str]:
         """ Retrieve IDs from the input list that are not present in the PostgreSQL database.
         Args:
@@ -74,8 +117,9 @@ class PostgresHandler:
             for i in range(0, len(input_ids), batch_size):
                 batch_ids = input_ids[i:i+batch_size]
                 query = sql.SQL("SELECT id FROM {} WHERE id = ANY(%s)").format(sql.Identifier(os.getenv('POSTGRES_TABLE')))
-                self.cursor.execute(query, (batch_ids,))
-                existing_ids = set(row[0] for row in self.cursor.fetchall())
+                with api_call('postgres', 'select_ids', ids=len(batch_ids)):
+                    self.cursor.execute(query, (batch_ids,))
+                    existing_ids = set(row[0] for row in self.cursor.fetchall())
                 ids_not_in_database.difference_update(existing_ids)
 
         except psycopg2.Error as e:
@@ -110,8 +154,9 @@ class PostgresHandler:
         """
         try:
             # Check if the ID exists
-            self.cursor.execute(sql.SQL("SELECT * FROM {} WHERE id = %s").format(sql.Identifier(os.getenv('POSTGRES_TABLE'))), (data['id'],))
-            result = self.cursor.fetchone()
+            with api_call('postgres', 'select_id'):
+                self.cursor.execute(sql.SQL("SELECT * FROM {} WHERE id = %s").format(sql.Identifier(os.getenv('POSTGRES_TABLE'))), (data['id'],))
+                result = self.cursor.fetchone()
 
             if result:
                 logging.info(f"Entry with ID {data['id']} already exists.")
@@ -123,8 +168,9 @@ class PostgresHandler:
                     sql.SQL(', ').join(map(sql.Identifier, columns)),
                     sql.SQL(', ').join(sql.Placeholder() * len(values))
                 )
-                self.cursor.execute(insert_query, values)
-                self.conn.commit()
+                with api_call('postgres', 'insert'):
+                    self.cursor.execute(insert_query, values)
+                    self.conn.commit()
                 logging.info(f"Inserted new entry with ID {data['id']}.")
                 
         except Exception as e:
@@ -143,11 +189,195 @@ class PostgresHandler:
                 sql.Identifier(os.getenv('POSTGRES_TABLE')),
                 sql.SQL("LIMIT %s") if n is not None else sql.SQL("")
             )
-            self.cursor.execute(query, (n,) if n is not None else None)
-            rows = self.cursor.fetchall()
+            with api_call('postgres', 'select_rows'):
+                self.cursor.execute(query, (n,) if n is not None else None)
+                rows = self.cursor.fetchall()
             logging.info(f"Retrieved {len(rows)} rows from the database.")
             return rows
 
         except psycopg2.Error as e:
             logging.error(f"Error: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def stream_rows(self, columns: Sequence[str] = DEFAULT_COLUMNS, itersize: int = 1000,
+                    after_id: Optional[str] = None) -> Iterator[Tuple]:
+        """ Stream rows from the PostgreSQL table with a server-side (named) cursor, so that only `itersize` rows are
+        held in memory at a time. Rows are ordered by ID, so an interrupted stream can be resumed with `after_id`.
+        Args:
+            columns (Sequence[str]): The columns to select.
+            itersize (int): The number of rows fetched from the server per round trip.
+            after_id (Optional[str]): Only stream rows with an ID greater than this one.
+        Yields:
+            Tuple: A row of the table.
+        Example:
+            >>> for id, title, summary in db.stream_rows(itersize=500):
+            ...     print(id)
+        """
+        query = self._select_query(columns, after_id)
+        with self.conn.cursor(name=f'stream_rows_{next(_cursor_ids)}') as cursor:
+            cursor.itersize = itersize
+            with api_call('postgres', 'stream_rows'):
+                cursor.execute(query, (after_id,) if after_id is not None else None)
+            yield from cursor
+        self.conn.commit()
+
+    def iter_row_batches(self, columns: Sequence[str] = DEFAULT_COLUMNS, batch_size: int = 1000,
+                         after_id: Optional[str] = None, output: str = 'rows') -> Iterator:
+        """ Iterate over the table in batches with keyset pagination (`WHERE id > last_id ORDER BY id LIMIT n`).
+        Every batch is a short, independent query, so no transaction or cursor stays open between batches and the
+        cost of a batch does not depend on how far into the table it is.
+        Args:
+            columns (Sequence[str]): The columns to select.
+            batch_size (int): The number of rows per batch.
+            after_id (Optional[str]): Only return rows with an ID greater than this one.
+            output (str): 'rows' for lists of tuples, 'numpy' for dicts mapping columns to NumPy arrays, or 'arrow'
+                for `pyarrow.RecordBatch` objects (requires pyarrow).
+        Yields:
+            A batch of rows in the requested output format.
+        Example:
+            >>> for batch in db.iter_row_batches(columns=('id', 'title'), output='numpy'):
+            ...     print(batch['id'][-1])
+        """
+        if output not in ('rows', 'numpy', 'arrow'):
+            raise ValueError("output must be 'rows', 'numpy' or 'arrow'.")
+
+        columns = list(columns)
+        # the ID is needed to find the start of the next batch
+        select_columns = columns if 'id' in columns else ['id'] + columns
+        id_position = select_columns.index('id')
+
+        last_id = after_id
+        while True:
+            query = self._select_query(select_columns, last_id, limit=True)
+            params = (last_id, batch_size) if last_id is not None else (batch_size,)
+            with api_call('postgres', 'select_batch'):
+                self.cursor.execute(query, params)
+                rows = self.cursor.fetchall()
+            self.conn.commit()
+            if not rows:
+                return
+
+            last_id = rows[-1][id_position]
+            if select_columns != columns:
+                rows = [row[1:] for row in rows]
+            yield self._format_batch(rows, columns, output)
+
+            if len(rows) < batch_size:
+                return
+
+    def _select_query(self, columns: Sequence[str], after_id: Optional[str], limit: bool = False) -> sql.Composed:
+        """ Build `SELECT columns FROM table [WHERE id > %s] ORDER BY id [LIMIT %s]`. """
+        return sql.SQL("SELECT {} FROM {} {} ORDER BY id {}").format(
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.Identifier(os.getenv('POSTGRES_TABLE')),
+            sql.SQL("WHERE id > %s") if after_id is not None else sql.SQL(""),
+            sql.SQL("LIMIT %s") if limit else sql.SQL("")
+        )
+
+    @staticmethod
+    def _format_batch(rows: List[Tuple], columns: Sequence[str], output: str):
+        """ Convert a batch of rows into the requested output format (see `iter_row_batches`). """
+        if output == 'rows':
+            return rows
+
+        values = list(zip(*rows))
+        if output == 'numpy':
+            import numpy as np
+            return {column: np.array(column_values) for column, column_values in zip(columns, values)}
+
+        import pyarrow as pa
+        return pa.RecordBatch.from_pydict({column: list(column_values) for column, column_values in zip(columns, values)})
+
+
+class PostgresPool:
+    """ A thread-safe pool of PostgreSQL connections for long-running services (see `bot.service`), which query the
+    article table from several threads at once. Connections are opened once and reused, in autocommit mode so that
+    no transaction stays open between queries. When all connections are in use, callers wait for one to be returned.
+    """
+    def __init__(self, minconn: int = 1, maxconn: int = 10):
+        """ Open the pool with the connection details of the environment (the same as `PostgresHandler`). """
+        import threading
+        from psycopg2.pool import ThreadedConnectionPool
+
+        if not check_env_variables():
+            logging.error("Missing required environment variables.")
+            raise EnvironmentError("Missing required environment variables.")
+
+        self.table = sql.Identifier(os.getenv('POSTGRES_TABLE'))
+        # ThreadedConnectionPool raises instead of waiting when it is exhausted
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connection_params())
+        logging.info(f"Opened a pool of up to {maxconn} database connections.")
+
+    @contextmanager
+    def connection(self):
+        """ Borrow a connection from the pool for the duration of a block. """
+        with self.available:
+            conn = self.pool.getconn()
+            try:
+                if not conn.autocommit:
+                    conn.autocommit = True
+                yield conn
+            finally:
+                self.pool.putconn(conn)
+
+    def close(self) -> None:
+        """ Close all connections of the pool. """
+        self.pool.closeall()
+        logging.info("Database connection pool closed.")
+
+    def fetch_articles(self, ids: Iterable[str], columns: Sequence[str] = ARTICLE_COLUMNS) -> Dict[str, dict]:
+        """ Fetch articles by ID with a single query.
+        Returns:
+            dict: Maps the IDs that were found to their articles (dicts of `columns`).
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        query = sql.SQL("SELECT {} FROM {} WHERE id = ANY(%s)").format(
+            sql.SQL(', ').join(map(sql.Identifier, columns)), self.table)
+        with self.connection() as conn, conn.cursor() as cursor:
+            with api_call('postgres', 'fetch_articles', ids=len(ids)):
+                cursor.execute(query, (ids,))
+                rows = cursor.fetchall()
+        return {row[0]: dict(zip(columns, row)) for row in rows}
+
+    def filter_articles(self, keywords: Sequence[str] = (), since: Optional[str] = None, until: Optional[str] = None,
+                        category: Optional[str] = None, limit: int = 20,
+                        columns: Sequence[str] = ARTICLE_COLUMNS) -> List[dict]:
+        """ Find the most recently published articles matching all filters.
+        Args:
+            keywords (Sequence[str]): Words that must all appear in the title or the abstract (case-insensitive).
+            since (str): Only articles published on or after this ISO date (e.g. '2024-01-31').
+            until (str): Only articles published before this ISO date.
+            category (str): Only articles of this primary category (e.g. 'q-fin.PM').
+            limit (int): The maximum number of articles.
+        Returns:
+            list: The articles (dicts of `columns`), the most recent first.
+        Example:
+            >>> pool.filter_articles(keywords=['portfolio'], since='2024-01-01', limit=5)
+        """
+        conditions, params = [], []
+        for keyword in keywords:
+            pattern = '%' + keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            conditions.append(sql.SQL("(title ILIKE %s OR summary ILIKE %s)"))
+            params += [pattern, pattern]
+        if since:
+            conditions.append(sql.SQL("published >= %s"))
+            params.append(since)
+        if until:
+            conditions.append(sql.SQL("published < %s"))
+            params.append(until)
+        if category:
+            conditions.append(sql.SQL("arxiv_primary_category = %s"))
+            params.append(category)
+        query = sql.SQL("SELECT {} FROM {} {} ORDER BY published DESC, id DESC LIMIT %s").format(
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            self.table,
+            sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("")
+        )
+        with self.connection() as conn, conn.cursor() as cursor:
+            with api_call('postgres', 'filter_articles'):
+                cursor.execute(query, params + [limit])
+                rows = cursor.fetchall()
+        return [dict(zip(columns, row)) for row in rows]
@@ -0,0 +1,269 @@
+import os
+import re
+import zlib
+import logging
+from collections import deque
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from bot.state import StateStore
+
+if TYPE_CHECKING:
+    import numpy as np
+    from bot.embeddings import FaissDatabase
+
+# largest prime below 2**32: MinHash values fit into uint32 and `a * h + b` never overflows uint64
+HASH_PRIME = 4294967291
+DEFAULT_NUM_PERM = 128
+DEFAULT_SHINGLE_SIZE = 3
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_WINDOW = 5000
+# signatures are compared against blocks of reference signatures to bound the memory of the comparison
+COMPARE_BLOCK = 2048
+# texts are hashed in batches to bound the memory of the (num_perm x shingles) matrix of permuted hashes
+SIGNATURE_BATCH = 256
+
+SUPPRESS = 'suppress'
+REPLY = 'reply'
+
+_VERSION = re.compile(r'v\d+$')
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def strip_version(arxiv_id: str) -> str:
+    """ Normalize an arXiv ID by removing its version suffix, e.g. '2401.01234v2' -> '2401.01234'. """
+    return _VERSION.sub('', arxiv_id.strip())
+
+
+def shingles(text: str, size: int = DEFAULT_SHINGLE_SIZE) -> List[str]:
+    """ Split a text into overlapping word n-grams, ignoring case and punctuation. """
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return [' '.join(words)]
+    return [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+def article_text(item: dict) -> str:
+    """ The text that is compared to find near-duplicates: the title and the abstract. """
+    return f"{item.get('title', '')} {item.get('summary', '')}"
+
+
+class MinHashDeduplicator:
+    """ Finds near-duplicate articles by comparing MinHash signatures of their title and abstract.
+
+    The signatures of processed articles are kept in the state store, so a run only hashes its own new articles and
+    compares them against the `window` most recent signatures in a single vectorized pass.
+    """
+    def __init__(self, store: StateStore, threshold: float = DEFAULT_THRESHOLD, num_perm: int = DEFAULT_NUM_PERM,
+                 window: int = DEFAULT_WINDOW, seed: int = 1):
+        """
+        Args:
+            store (StateStore): Where the signatures of processed articles are kept.
+            threshold (float): The estimated Jaccard similarity above which two articles are near-duplicates.
+            num_perm (int): The number of hash permutations of a signature.
+            window (int): The number of most recent signatures new articles are compared against.
+            seed (int): Seed of the hash permutations (must not change once signatures are stored).
+        """
+        import numpy as np
+
+        self.store = store
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.window = window
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+
+    def signatures(self, texts: List[str]) -> 'np.ndarray':
+        """ Compute the MinHash signatures of texts as a (len(texts), num_perm) uint32 matrix.
+        All shingles of `SIGNATURE_BATCH` texts are hashed with every permutation at once, and the minimum of each text
+        is taken with a single `minimum.reduceat`, so memory does not grow with the number of texts.
+        """
+        import numpy as np
+
+        signatures = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(texts), SIGNATURE_BATCH):
+            hashes, offsets = [], []
+            for text in texts[start:start + SIGNATURE_BATCH]:
+                offsets.append(len(hashes))
+                hashes.extend(zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text))
+            permuted = self.a[:, None] * np.asarray(hashes, dtype=np.uint64)[None, :]
+            permuted += self.b[:, None]
+            permuted %= HASH_PRIME
+            signatures[start:start + len(offsets)] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return signatures
+
+    def find_duplicates(self, metadata: List[dict]) -> Dict[str, str]:
+        """ Find the articles that are near-duplicates of an earlier article.
+        Articles are compared against the recently processed ones and against the articles listed before them in
+        `metadata` (e.g. two near-identical preprints announced on the same day).
+        Args:
+            metadata (list): The articles to check, with at least 'id', 'title' and 'summary'.
+        Returns:
+            dict: Maps the IDs of near-duplicates to the ID of the article they duplicate.
+        """
+        import numpy as np
+
+        if not metadata:
+            return {}
+        ids = [strip_version(item['id']) for item in metadata]
+        signatures = self.signatures([article_text(item) for item in metadata])
+
+        reference = self.store.load_signatures(self.window)
+        ref_ids = [id for id, _ in reference]
+        base_ids = np.asarray(ids)
+        raw_ids = np.asarray([item['id'] for item in metadata])
+        best_score = np.zeros(len(ids))
+        best_match = np.full(len(ids), -1)
+        if reference:
+            ref_signatures = np.frombuffer(b''.join(signature for _, signature in reference),
+                                           dtype=np.uint32).reshape(len(reference), self.num_perm)
+            for start in range(0, len(ref_ids), COMPARE_BLOCK):
+                block = ref_signatures[start:start + COMPARE_BLOCK]
+                block_ids = np.asarray(ref_ids[start:start + COMPARE_BLOCK])
+                scores = (signatures[:, None, :] == block[None, :, :]).mean(axis=2)
+                # another version of an article that was already processed is a duplicate whatever its text, but an
+                # article retried after a failed run is not a duplicate of itself
+                scores[base_ids[:, None] == block_ids[None, :]] = 1
+                scores[raw_ids[:, None] == block_ids[None, :]] = 0
+                block_best = scores.argmax(axis=1)
+                block_score = scores[np.arange(len(ids)), block_best]
+                better = block_score > best_score
+                best_score[better] = block_score[better]
+                best_match[better] = block_best[better] + start
+
+        # within the batch, an article can only duplicate one that is listed before it
+        batch_scores = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+        batch_scores[base_ids[:, None] == base_ids[None, :]] = 1
+        batch_scores[raw_ids[:, None] == raw_ids[None, :]] = 0
+        batch_scores[np.triu_indices(len(ids))] = 0
+        batch_best = batch_scores.argmax(axis=1)
+        batch_score = batch_scores[np.arange(len(ids)), batch_best]
+
+        duplicates = {}
+        for i, item in enumerate(metadata):
+            if batch_score[i] >= self.threshold and batch_score[i] >= best_score[i]:
+                duplicates[item['id']] = metadata[batch_best[i]]['id']
+            elif best_score[i] >= self.threshold:
+                duplicates[item['id']] = ref_ids[best_match[i]]
+        logging.info(f"Found {len(duplicates)} near-duplicates among {len(metadata)} articles.")
+        return duplicates
+
+    def remember(self, metadata: List[dict]) -> None:
+        """ Store the signatures of processed articles, so later runs compare new articles against them. """
+        signatures = self.signatures([article_text(item) for item in metadata])
+        self.store.save_signatures({strip_version(item['id']): signature.tobytes()
+                                    for item, signature in zip(metadata, signatures)})
+
+    def seed(self, rows: Iterable[Tuple[str, str, str]]) -> None:
+        """ Fill an empty signature store from already processed articles, e.g. `PostgresHandler.stream_rows()`.
+        Only the last `window` rows are kept, so the rows should be ordered from oldest to newest.
+        Args:
+            rows (iterable): (id, title, summary) rows.
+        """
+        recent = deque(rows, maxlen=self.window)
+        self.remember([{'id': id, 'title': title, 'summary': summary} for id, title, summary in recent])
+        logging.info(f"Seeded {len(recent)} near-duplicate signatures.")
+
+
+class EmbeddingDeduplicator:
+    """ Finds near-duplicate articles by the cosine similarity of their abstract embeddings to the vector index
+    (see `bot.embeddings`). The new articles are embedded with one request and searched with one Faiss call.
+    """
+    def __init__(self, index: 'FaissDatabase', threshold: float = 0.95, api_key: Optional[str] = None):
+        """
+        Args:
+            index (FaissDatabase): The vector index of processed articles.
+            threshold (float): The cosine similarity above which two articles are near-duplicates.
+            api_key (str): The OpenAI API key. Defaults to the `OPENAI_TOKEN` environment variable.
+        """
+        self.index = index
+        self.threshold = threshold
+        self.api_key = api_key or os.getenv('OPENAI_TOKEN')
+
+    def find_duplicates(self, metadata: List[dict]) -> Dict[str, str]:
+        """ Find the articles that are near-duplicates of an indexed article or of an article listed before them.
+        Returns:
+            dict: Maps the IDs of near-duplicates to the ID of the article they duplicate.
+        """
+        import numpy as np
+        from bot.openai import convert_texts_to_embeddings
+
+        if not metadata:
+            return {}
+        vectors = self.index.normalize_embeddings(np.asarray(convert_texts_to_embeddings(
+            [item['summary'].replace('\n', ' ') for item in metadata], self.api_key), dtype='float32'))
+        ids = [strip_version(item['id']) for item in metadata]
+
+        raw_ids = [item['id'] for item in metadata]
+        best_score = np.zeros(len(ids))
+        best_match = [None] * len(ids)
+        if self.index.index.ntotal:
+            # squared L2 distances of unit vectors: cos = 1 - d / 2. Two neighbours are searched, since an article
+            # retried after a failed run may already be indexed and is not a duplicate of itself
+            distances, indices = self.index.index.search(vectors, 2)
+            for i in range(len(ids)):
+                for distance, position in zip(distances[i], indices[i]):
+                    if position >= 0 and self.index.ids[position] != raw_ids[i]:
+                        best_score[i], best_match[i] = 1 - distance / 2, self.index.ids[position]
+                        break
+        # another version of an indexed article is a duplicate whatever its text
+        for i, id in enumerate(ids):
+            if id in self.index.existing_ids and id != raw_ids[i]:
+                best_score[i], best_match[i] = 1, id
+
+        base_ids = np.asarray(ids)
+        batch_scores = vectors @ vectors.T
+        batch_scores[base_ids[:, None] == base_ids[None, :]] = 1
+        batch_scores[np.asarray(raw_ids)[:, None] == np.asarray(raw_ids)[None, :]] = 0
+        batch_scores[np.triu_indices(len(ids))] = 0
+        batch_best = batch_scores.argmax(axis=1)
+
+        duplicates = {}
+        for i, item in enumerate(metadata):
+            batch_score = batch_scores[i, batch_best[i]]
+            if batch_score >= self.threshold and batch_score >= best_score[i]:
+                duplicates[item['id']] = metadata[batch_best[i]]['id']
+            elif best_score[i] >= self.threshold:
+                duplicates[item['id']] = best_match[i]
+        logging.info(f"Found {len(duplicates)} near-duplicates among {len(metadata)} articles.")
+        return duplicates
+
+    def remember(self, metadata: List[dict]) -> None:
+        """ The vector index is updated by `python -m bot.embeddings update-index`, so nothing is stored here. """
+
+
+def load_deduplicator(store: StateStore, db=None):
+    """ Create the deduplicator configured by the environment:
+    `DEDUP_METHOD` ('minhash', the default, 'embedding' or 'none'), `DEDUP_THRESHOLD` and `DEDUP_WINDOW`.
+    The embedding method compares against the vector index in `FAISS_INDEX_DIR`.
+    Args:
+        store (StateStore): The state store that keeps the MinHash signatures.
+        db (PostgresHandler): If given, an empty signature store is seeded once from the articles in the database.
+    Returns:
+        The deduplicator, or None if deduplication is disabled.
+    """
+    method = os.getenv('DEDUP_METHOD', 'minhash').lower()
+    threshold = os.getenv('DEDUP_THRESHOLD')
+    if method == 'none':
+        return None
+    if method == 'embedding':
+        from bot.embeddings import DEFAULT_EMBEDDING_DIM, DEFAULT_INDEX_DIR, FaissDatabase
+        index = FaissDatabase.load(os.getenv('FAISS_INDEX_DIR', DEFAULT_INDEX_DIR), DEFAULT_EMBEDDING_DIM)
+        return EmbeddingDeduplicator(index, float(threshold) if threshold else 0.95)
+    if method == 'minhash':
+        deduplicator = MinHashDeduplicator(store, float(threshold) if threshold else DEFAULT_THRESHOLD,
+                                           window=int(os.getenv('DEDUP_WINDOW', DEFAULT_WINDOW)))
+        if db is not None and not store.count_signatures():
+            deduplicator.seed(db.stream_rows())
+        return deduplicator
+    raise ValueError(f"Invalid DEDUP_METHOD: {method}. Must be 'minhash', 'embedding' or 'none'.")
+
+
+def dedup_mode() -> str:
+    """ What happens to near-duplicates, from `DEDUP_MODE`: 'suppress' (the default) skips them, 'reply' posts them
+    as a reply to the original post in the same channel.
+    """
+    mode = os.getenv('DEDUP_MODE', SUPPRESS).lower()
+    if mode not in (SUPPRESS, REPLY):
+        raise ValueError(f"Invalid DEDUP_MODE: {mode}. Must be '{SUPPRESS}' or '{REPLY}'.")
+    return mode
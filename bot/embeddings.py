@@ -1,26 +1,42 @@
 import os
-import faiss
+import re
 import time
 import pickle
-import numpy as np
-from dotenv import load_dotenv
-from typing import List
+import shutil
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional
 
-from bot.database import connect_to_postgres, retrieve_first_n_rows, retrieve_all_rows
-from bot.openai import convert_text_to_embedding
+from bot.openai import convert_texts_to_embeddings
 
-load_dotenv()
+DEFAULT_INDEX_DIR = 'faiss_db'
+DEFAULT_EMBEDDING_DIM = 1536
+_SHARD = re.compile(r'shard-(\d+)')
 
 class FaissDatabase:
-    """ A database class for storing and searching embeddings using Faiss. """
-    def __init__(self, embedding_dim):
+    """ A database class for storing and searching embeddings using Faiss.
+    Faiss and NumPy are imported when the first database is created, not when this module is imported.
+    """
+    def __init__(self, embedding_dim, store_embeddings: bool = True):
+        """ Initialize an empty database.
+        Args:
+            embedding_dim (int): The dimension of the embeddings.
+            store_embeddings (bool): Whether to keep a copy of the raw embeddings next to the index. Without it, the
+                (normalized) vectors are read back from the index, which halves the memory footprint.
+        """
+        import faiss
+
         self.embedding_dim = embedding_dim
+        self.store_embeddings = store_embeddings
         self.index = faiss.IndexFlatL2(embedding_dim)
         self.ids = []
         self.titles = []
         self.texts = []
         self.embeddings = []
         self.existing_ids = set()
+        self.positions = {}
 
     def insert_data(self, data: tuple) -> None:
         """ Insert data into the database.
@@ -45,32 +61,53 @@ class FaissDatabase:
         if not new_data:
             return
         
-        new_ids, new_titles, new_texts, new_embeddings = zip(*new_data)
-        self.existing_ids.update(new_ids)
+        import numpy as np
 
+        new_ids, new_titles, new_texts, new_embeddings = zip(*new_data)
         np_embeddings = np.array(new_embeddings).astype('float32')
-        np_embeddings = self.normalize_embeddings(np_embeddings)
+        self.add_vectors(new_ids, new_titles, new_texts, self.normalize_embeddings(np_embeddings))
+        if self.store_embeddings:
+            self.embeddings.extend(new_embeddings)
 
-        self.index.add(np_embeddings)
+    def add_vectors(self, ids, titles, texts, vectors) -> None:
+        """ Add already normalized vectors to the index, skipping IDs that are already present.
+        Args:
+            ids (list): List of IDs.
+            titles (list): List of titles.
+            texts (list): List of texts.
+            vectors (np.ndarray): Normalized float32 vectors, one row per ID.
+        """
+        keep = [i for i, id in enumerate(ids) if id not in self.existing_ids]
+        if not keep:
+            return
+        if len(keep) < len(ids):
+            ids, titles, texts, vectors = [ids[i] for i in keep], [titles[i] for i in keep], [texts[i] for i in keep], vectors[keep]
 
-        self.ids.extend(new_ids)
-        self.titles.extend(new_titles)
-        self.texts.extend(new_texts)
-        self.embeddings.extend(new_embeddings)
+        self.index.add(vectors)
+        self.positions.update((id, len(self.ids) + i) for i, id in enumerate(ids))
+        self.existing_ids.update(ids)
+        self.ids.extend(ids)
+        self.titles.extend(titles)
+        self.texts.extend(texts)
 
-    def normalize_embeddings(self, embeddings):
-        """ Normalize the embeddings.
+    @staticmethod
+    def normalize_embeddings(embeddings):
+        """ Normalize the embeddings to unit length. All-zero embeddings are left as they are.
         Args:
-            embeddings (list): List of embeddings.
+            embeddings (np.ndarray): One embedding per row.
         Returns:
-            list: List of normalized embeddings.
+            np.ndarray: The normalized embeddings.
         Example:
-            >>> embeddings_norm = db.normalize_embeddings(embeddings)
+            >>> embeddings_norm = FaissDatabase.normalize_embeddings(embeddings)
         """
+        import numpy as np
+
         norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-        return embeddings / norms
+        return embeddings / np.where(norms == 0, 1, norms)
 
     def search(self, query_embedding, k):
+        import numpy as np
+
         query_embedding = np.array(query_embedding).astype('float32').reshape(1, -1)
         query_embedding = self.normalize_embeddings(query_embedding)  # Normalize query embedding
         distances, indices = self.index.search(query_embedding, k)
@@ -88,6 +125,8 @@ class FaissDatabase:
         Example:
             >>> results = db.search_cosine_knn(query_embedding, k=5)
         """
+        import numpy as np
+
         query_embedding = np.array(query_embedding).astype('float32').reshape(1, -1)
         query_embedding = self.normalize_embeddings(query_embedding)
         distances, indices = self.index.search(query_embedding, k)
@@ -102,20 +141,32 @@ class FaissDatabase:
         Returns:
             int: The index of the target ID in the list, or -1 if not found.
         """
-        try:
-            index = self.ids.index(target_id)
-            return index
-        except ValueError:
-            return -1
+        return self.positions.get(target_id, -1)
+
+    def get_embedding(self, index: int):
+        """ Return the embedding stored at a position of the index.
+        Args:
+            index (int): The position (see `find_index_by_id`).
+        Returns:
+            The raw embedding if embeddings are stored, otherwise the normalized vector read back from the index.
+        """
+        if index < len(self.embeddings):
+            return self.embeddings[index]
+        return self.index.reconstruct(index)
 
     def save_index(self, file_path: str):
-        """ Save the Faiss index into a file.
+        """ Save the Faiss index into a file. The index is written to a temporary file first and then renamed, so
+        readers never see a partially written index.
         Args:
             file_path (str): The path to the file to save the index to.
         Example:
             >>> db.save_index('index.faiss')
         """
-        faiss.write_index(self.index, file_path)
+        import faiss
+
+        tmp_file_path = f"{file_path}.tmp"
+        faiss.write_index(self.index, tmp_file_path)
+        os.replace(tmp_file_path, file_path)
 
     def load_index(self, file_path: str):
         """ Load the Faiss index from a file.
@@ -124,20 +175,24 @@ class FaissDatabase:
         Example:
             >>> db.load_index('index.faiss')
         """
+        import faiss
+
         self.index = faiss.read_index(file_path)
 
     def save_metadata(self, file_path: str):
-        """ Save additional data (ids and texts)
+        """ Save additional data (ids and texts). Like the index, the file is replaced atomically.
         Args:
             file_path (str): The path to the file to save the metadata to.
         Example:
             >>> db.save_metadata('metadata.pkl')
         """
-        with open(file_path, 'wb') as f:
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, 'wb') as f:
             pickle.dump({'ids': self.ids, 
                          'titles': self.titles,
                          'texts': self.texts,
-                         'embeddings': self.embeddings}, f)
+                         'embeddings': self.embeddings}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_path, file_path)
 
     def load_metadata(self, file_path: str):
         """ Load additional data (ids and texts)
@@ -152,55 +207,257 @@ class FaissDatabase:
             self.titles = data['titles']
             self.texts = data['texts']
             self.embeddings = data['embeddings']
+        self.existing_ids = set(self.ids)
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+
+    def save(self, directory: str = DEFAULT_INDEX_DIR) -> None:
+        """ Save the index and the metadata into a directory (index.faiss and metadata.pkl).
+
+        Both files are written to a new versioned directory next to it (e.g. `faiss_db.v1718000000000000000`), and
+        `directory` is then switched to it with a single atomic rename of a symbolic link. A reader therefore always
+        loads an index and metadata of the same version (see `load`). The previous version is kept for readers that
+        are still loading it, older ones are removed.
+        """
+        parent, name = os.path.split(os.path.normpath(directory))
+        parent = parent or '.'
+        version = f"{name}.v{time.time_ns()}"
+        os.makedirs(os.path.join(parent, version))
+        self.save_index(os.path.join(parent, version, 'index.faiss'))
+        self.save_metadata(os.path.join(parent, version, 'metadata.pkl'))
+
+        if os.path.islink(directory):
+            previous = os.path.basename(os.path.realpath(directory))
+        elif os.path.isdir(directory):
+            # a directory written before versions were introduced is moved aside once
+            previous = f"{name}.v0"
+            os.rename(directory, os.path.join(parent, previous))
+        else:
+            previous = None
+        link = os.path.join(parent, f".{version}.link")
+        os.symlink(version, link)
+        os.replace(link, directory)
+
+        for entry in os.listdir(parent):
+            if re.fullmatch(re.escape(name) + r'\.v\d+', entry) and entry not in (version, previous):
+                shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+    def save_shard(self, directory: str) -> str:
+        """ Save the database as a new shard of a directory (`shard-<timestamp>/index.faiss` and `metadata.pkl`).
+
+        Unlike `save`, the shards already in the directory are neither rewritten nor loaded, so a large index can be
+        built in small parts, each one held in memory and written only once. The shard is written under a temporary
+        name and renamed once complete. `load` reads all shards of a directory.
+        Returns:
+            str: The path of the shard.
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = f"shard-{time.time_ns()}"
+        tmp_path = os.path.join(directory, f".{name}.tmp")
+        os.makedirs(tmp_path)
+        self.save_index(os.path.join(tmp_path, 'index.faiss'))
+        self.save_metadata(os.path.join(tmp_path, 'metadata.pkl'))
+        path = os.path.join(directory, name)
+        os.rename(tmp_path, path)
+        return path
+
+    def load_shards(self, directory: str) -> int:
+        """ Add the shards saved with `save_shard` into a directory to the database, oldest first. IDs that are
+        already present (e.g. written again after an interrupted run) are skipped.
+        Returns:
+            int: The number of shards.
+        """
+        shards = sorted((int(match.group(1)), match.group(0)) for match in map(_SHARD.fullmatch, os.listdir(directory))
+                        if match)
+        for _, name in shards:
+            shard = type(self)(self.embedding_dim, store_embeddings=False)
+            shard.load_index(os.path.join(directory, name, 'index.faiss'))
+            shard.load_metadata(os.path.join(directory, name, 'metadata.pkl'))
+            self.add_vectors(shard.ids, shard.titles, shard.texts, shard.index.reconstruct_n(0, shard.index.ntotal))
+        return len(shards)
+
+    @classmethod
+    def load(cls, directory: str = DEFAULT_INDEX_DIR, embedding_dim: int = DEFAULT_EMBEDDING_DIM):
+        """ Load a database saved with `save`, together with the shards saved into it with `save_shard`. The directory
+        link is resolved once, so the index and the metadata come from the same version even if a new one is saved
+        meanwhile.
+        Example:
+            >>> db = FaissDatabase.load('faiss_db')
+        """
+        while True:
+            linked, version = os.path.islink(directory), os.path.realpath(directory)
+            try:
+                db = cls(embedding_dim)
+                whole = os.path.exists(os.path.join(version, 'index.faiss'))
+                if whole:
+                    db.load_index(os.path.join(version, 'index.faiss'))
+                    db.load_metadata(os.path.join(version, 'metadata.pkl'))
+                    db.store_embeddings = bool(db.embeddings)
+                if not db.load_shards(version) and not whole:
+                    raise FileNotFoundError(f"No index in {directory}.")
+            except (OSError, RuntimeError):
+                # the version was removed by newer saves while it was being read: load the current one
+                if os.path.realpath(directory) == version:
+                    raise
+                continue
+            # a directory written before versions were introduced may have been replaced while it was being read
+            if linked or os.path.realpath(directory) == version:
+                return db
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """ Split an iterable into lists of at most `size` items without materializing it. """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bounded_map(executor: Executor, function: Callable, iterable: Iterable, window: int) -> Iterator:
+    """ Like `executor.map`, but with at most `window` tasks in flight, so the input is consumed lazily and memory
+    stays bounded. Results are yielded in input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def embed_rows(rows: list, api_key: str):
+    """ Embed the abstracts of a batch of (id, title, summary) rows with a single OpenAI call.
+    Returns:
+        tuple: The rows and their embeddings as a float32 array.
+    """
+    import numpy as np
+
+    texts = [(row[2] or row[1] or '').replace("\n", " ") for row in rows]
+    return rows, np.array(convert_texts_to_embeddings(texts, api_key), dtype=np.float32)
+
+
+def normalize_rows(batch):
+    """ Normalize the embeddings of a batch to unit length (run in a worker process). """
+    rows, vectors = batch
+    return rows, FaissDatabase.normalize_embeddings(vectors)
+
+
+def index_rows(db: FaissDatabase, rows: Iterable, api_key: str, batch_size: int = 100, workers: int = 4,
+               processes: int = 2, chunk_size: int = 1000) -> int:
+    """ Embed rows and add them to a database.
+
+    Rows are consumed lazily: batches of `batch_size` rows are embedded by `workers` concurrent requests, grouped into
+    chunks of `chunk_size` vectors, normalized in a pool of `processes` worker processes and added to the index chunk
+    by chunk. Only a bounded number of batches is in flight, so memory does not grow with the number of rows
+    (besides the index itself).
+    Args:
+        db (FaissDatabase): The database to add the rows to.
+        rows (iterable): (id, title, summary) rows, e.g. from `PostgresHandler.stream_rows`.
+        api_key (str): OpenAI API key.
+        batch_size (int): The number of texts per embedding request.
+        workers (int): The number of concurrent embedding requests.
+        processes (int): The number of processes normalizing the vectors.
+        chunk_size (int): The number of vectors normalized and added at once.
+    Returns:
+        int: The number of rows added.
+    """
+    import numpy as np
+
+    added, start = 0, time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as threads, ProcessPoolExecutor(max_workers=processes) as pool:
+        embedded = bounded_map(threads, lambda batch: embed_rows(batch, api_key), batched(rows, batch_size), 2 * workers)
+        chunks = ((sum((rows for rows, _ in group), []), np.concatenate([vectors for _, vectors in group]))
+                  for group in batched(embedded, max(1, chunk_size // batch_size)))
+        for chunk_rows, vectors in bounded_map(pool, normalize_rows, chunks, 2 * processes):
+            db.add_vectors([row[0] for row in chunk_rows], [row[1] for row in chunk_rows],
+                           [row[2] for row in chunk_rows], vectors)
+            added += len(chunk_rows)
+            logging.info(f"Indexed {added} rows ({added / (time.perf_counter() - start):.1f} rows/s).")
+    return added
+
+
+def rebuild_index(args) -> None:
+    """ Re-embed every article of the database into a new index. """
+    from bot.database import PostgresHandler
+
+    handler = PostgresHandler()
+    try:
+        db = FaissDatabase(args.dim, store_embeddings=False)
+        added = index_rows(db, handler.stream_rows(itersize=args.itersize), os.getenv('OPENAI_TOKEN'),
+                           args.batch_size, args.workers, args.processes, args.chunk_size)
+    finally:
+        handler.close_connection()
+    db.save(args.index_dir)
+    print(f"Rebuilt the index in {args.index_dir} with {added} articles.")
+
+
+def update_index(args) -> None:
+    """ Embed the articles of the database that are not in the index yet. """
+    from bot.database import PostgresHandler
+
+    db = FaissDatabase.load(args.index_dir, args.dim)
+    handler = PostgresHandler()
+    try:
+        rows = (row for row in handler.stream_rows(itersize=args.itersize) if row[0] not in db.existing_ids)
+        added = index_rows(db, rows, os.getenv('OPENAI_TOKEN'), args.batch_size, args.workers, args.processes, args.chunk_size)
+    finally:
+        handler.close_connection()
+    if added:
+        db.save(args.index_dir)
+    print(f"Added {added} articles to the index in {args.index_dir} ({len(db.ids)} in total).")
+
+
+def query_index(args) -> None:
+    """ Print the nearest neighbours of an article of the index or of a free text. """
+    db = FaissDatabase.load(args.index_dir, args.dim)
+    if args.id:
+        position = db.find_index_by_id(args.id)
+        if position < 0:
+            raise SystemExit(f"Article {args.id} is not in the index.")
+        query_embedding = db.get_embedding(position)
+    else:
+        query_embedding = convert_texts_to_embeddings([args.text], os.getenv('OPENAI_TOKEN'))[0]
+
+    for r in db.search_cosine_knn(query_embedding, k=args.k):
+        print(f"ID: {r[0]}, Score: {r[3]}, Title: {r[1]}")
+        print("Abstract:", r[2])
+        print("\n")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Build and query the Faiss index of the articles.')
+    parser.add_argument('--index-dir', default=DEFAULT_INDEX_DIR, help='Directory of index.faiss and metadata.pkl.')
+    parser.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help='Embedding dimension.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, function, help in (('rebuild-index', rebuild_index, 'Re-embed all articles into a new index.'),
+                                 ('update-index', update_index, 'Embed the articles missing from the index.')):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument('--batch-size', type=int, default=100, help='Texts per embedding request.')
+        subparser.add_argument('--workers', type=int, default=4, help='Concurrent embedding requests.')
+        subparser.add_argument('--processes', type=int, default=2, help='Processes normalizing the vectors.')
+        subparser.add_argument('--chunk-size', type=int, default=1000, help='Vectors added to the index at once.')
+        subparser.add_argument('--itersize', type=int, default=1000, help='Rows fetched from PostgreSQL per round trip.')
+        subparser.set_defaults(function=function)
+
+    query = subparsers.add_parser('query', help='Find the nearest neighbours of an article or a text.')
+    target = query.add_mutually_exclusive_group(required=True)
+    target.add_argument('--id', help='arXiv ID of an indexed article.')
+    target.add_argument('--text', help='Free text.')
+    query.add_argument('-k', type=int, default=5, help='Number of neighbours.')
+    query.set_defaults(function=query_index)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
 
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s')
 
-api_key = os.getenv('OPENAI_TOKEN')
-db_password = os.getenv('POSTGRES_PASSWORD')
-db_name = os.getenv('POSTGRES_DB')
-db_table = os.getenv('POSTGRES_TABLE')
-db_port = os.getenv('POSTGRES_PORT')
-
-conn, cursor = connect_to_postgres(password=db_password, database=db_name, port=db_port)
-#data = retrieve_first_n_rows(n=20, cursor=cursor, table_name=db_table)
-data = retrieve_all_rows(cursor=cursor, table_name=db_table)
-
-embedding_dim = 1536
-db = FaissDatabase(embedding_dim)
-
-# # === insert embeddings into vector index === #
-# for i, item in enumerate(data):
-#     print(f"Processing item {i} of {len(data)} ...")
-#     embedding = convert_text_to_embedding(item[2].replace("\n", " "), api_key)
-#     data[i] = (*item, embedding)
-#     if i % 10 == 0:
-#         time.sleep(1)
-
-# print("Inserting data into vector index ...")
-# db.insert_data(data)
-# # === end of inserting embeddings into vector index === #
-#
-# # === save index and metadata === #
-# print("Saving index and metadata ...")
-# db.save_index('faiss_db/index.faiss')
-# db.save_metadata('faiss_db/metadata.pkl')
-# print("Finished saving index and metadata.")
-# # === end of saving index and metadata === #
-
-# === load index and metadata === #
-print("Loading index and metadata ...")
-db.load_index('faiss_db/index.faiss')
-db.load_metadata('faiss_db/metadata.pkl')
-print("Finished loading index and metadata.")
-
-target_id = '2305.08530'
-paper_index = db.find_index_by_id(target_id)
-
-knn_results = db.search_cosine_knn(db.embeddings[paper_index], k=5)
-for r in knn_results:
-    print(f"ID: {r[0]}, Score: {r[3]}, Title: {r[1]}")
-    print("Abstract:", r[2])
-    print("\n")
-# === end of loading index and metadata === #
-
-cursor.close()
-conn.close()
\ No newline at end of file
+    args = parse_args()
+    args.function(args)
@@ -0,0 +1,238 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+DEFAULT_METRICS_PATH = './logs/metrics.prom'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# the OpenTelemetry tracer is looked up on the first span (False: not looked up yet, None: not installed)
+_tracer = False
+
+
+def get_tracer():
+    """ Return the OpenTelemetry tracer of the bot, or None if OpenTelemetry is not installed. """
+    global _tracer
+    if _tracer is False:
+        try:
+            from opentelemetry import trace
+            _tracer = trace.get_tracer('arxiv-telegram-bot')
+        except ImportError:
+            _tracer = None
+    return _tracer
+
+
+def format_labels(names: Tuple[str, ...], values: tuple, extra: Optional[Tuple[str, str]] = None) -> str:
+    """ Format label names and values in the Prometheus text format, e.g. '{stage="post"}'. """
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Counter:
+    """ A monotonically increasing counter with optional labels. """
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """ Increase the counter of the given label values by `amount`. """
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> str:
+        """ Render the counter in the Prometheus text format. """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return '\n'.join(lines)
+
+
+class Histogram:
+    """ A histogram of observed values (e.g. durations in seconds) with optional labels. """
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[tuple, dict] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        """ Record an observation for the given label values. """
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            series = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> str:
+        """ Render the histogram in the Prometheus text format. """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', bound))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', '+Inf'))} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {series['count']}")
+        return '\n'.join(lines)
+
+
+class MetricsRegistry:
+    """ A collection of metrics that can be rendered in the Prometheus text format. """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        """ Create and register a counter. """
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """ Create and register a histogram. """
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """ Render all metrics in the Prometheus text format. """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_DURATION = REGISTRY.histogram('arxiv_bot_stage_duration_seconds', 'Duration of the pipeline stages.', ('stage',))
+STAGE_ITEMS = REGISTRY.counter('arxiv_bot_stage_items_total', 'Number of items processed by the pipeline stages.', ('stage',))
+API_CALLS = REGISTRY.counter('arxiv_bot_api_calls_total', 'Number of calls to external services.', ('service', 'operation'))
+API_ERRORS = REGISTRY.counter('arxiv_bot_api_errors_total', 'Number of failed calls to external services.', ('service', 'operation'))
+API_RETRIES = REGISTRY.counter('arxiv_bot_api_retries_total', 'Number of retried calls to external services.', ('service', 'operation'))
+API_DURATION = REGISTRY.histogram('arxiv_bot_api_duration_seconds', 'Duration of calls to external services.', ('service', 'operation'))
+BYTES_RECEIVED = REGISTRY.counter('arxiv_bot_bytes_received_total', 'Number of bytes received from external services.', ('service',))
+OPENAI_TOKENS = REGISTRY.counter('arxiv_bot_openai_tokens_total', 'Number of OpenAI tokens used.', ('model', 'kind'))
+CACHE_LOOKUPS = REGISTRY.counter('arxiv_bot_cache_lookups_total', 'Number of cache lookups.', ('cache', 'result'))
+REQUEST_DURATION = REGISTRY.histogram('arxiv_bot_request_duration_seconds', 'Duration of the requests to the query services.', ('endpoint',))
+SEARCH_BATCH_SIZE = REGISTRY.histogram('arxiv_bot_search_batch_size', 'Number of queries answered by one batched call.', ('operation',),
+                                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """ Wrap a block into an OpenTelemetry span if OpenTelemetry is installed, and do nothing otherwise.
+    Example:
+        >>> with span('arxiv.query', ids=10):
+        ...     pass
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+    with tracer.start_as_current_span(name, attributes=attributes) as current_span:
+        yield current_span
+
+
+@contextmanager
+def stage(name: str):
+    """ Time a pipeline stage and record its duration in `STAGE_DURATION`.
+    Example:
+        >>> with stage('fetch_listing'):
+        ...     response = fetcher.fetch_updates()
+    """
+    start = time.perf_counter()
+    with span(f'pipeline.{name}'):
+        try:
+            yield
+        finally:
+            STAGE_DURATION.observe(time.perf_counter() - start, stage=name)
+
+
+@contextmanager
+def api_call(service: str, operation: str, **attributes):
+    """ Count, time and trace a call to an external service. Failed calls are counted in `API_ERRORS`.
+    Example:
+        >>> with api_call('arxiv', 'query', ids=10):
+        ...     response = urllib.request.urlopen(url).read()
+    """
+    API_CALLS.inc(service=service, operation=operation)
+    start = time.perf_counter()
+    with span(f'{service}.{operation}', **attributes):
+        try:
+            yield
+        except Exception:
+            API_ERRORS.inc(service=service, operation=operation)
+            raise
+        finally:
+            API_DURATION.observe(time.perf_counter() - start, service=service, operation=operation)
+
+
+def record_openai_usage(model: str, usage) -> None:
+    """ Record the token usage reported in an OpenAI response (if any). """
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(getattr(usage, 'prompt_tokens', 0) or 0, model=model, kind='prompt')
+    OPENAI_TOKENS.inc(getattr(usage, 'completion_tokens', 0) or 0, model=model, kind='completion')
+
+
+def write_metrics(filepath: Optional[str] = None) -> None:
+    """ Write all metrics to a file in the Prometheus text format (e.g. for the node exporter textfile collector).
+    The file is replaced atomically so that a scraper never reads a partial file.
+    Args:
+        filepath (str): The output file. Defaults to the `METRICS_PATH` environment variable.
+    """
+    filepath = filepath or os.getenv('METRICS_PATH', DEFAULT_METRICS_PATH)
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, 'w') as file:
+        file.write(REGISTRY.render())
+    os.replace(tmp_filepath, filepath)
+    logging.info(f"Metrics written to {filepath}")
+
+
+def start_metrics_server(port: int, host: Optional[str] = None):
+    """ Serve the metrics on http://host:port/metrics from a daemon thread (for long-running schedulers).
+    Args:
+        port (int): The port to listen on.
+        host (str): The interface to listen on. Defaults to the `METRICS_HOST` environment variable, or 127.0.0.1.
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    host = host or os.getenv('METRICS_HOST', DEFAULT_METRICS_HOST)
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """ Serves the metrics of `REGISTRY` on `/metrics`. """
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
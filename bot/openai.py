@@ -1,6 +1,14 @@
-import openai
-from openai import OpenAI
-import logging
+from bot.metrics import api_call, record_openai_usage
+from bot.resilience import call_with_retry, request_timeout
+
+
+def openai_client(api_key: str):
+    """ Create an OpenAI client with the request timeout. Retries are left to `call_with_retry`, which shares a
+    circuit breaker between all OpenAI calls.
+    """
+    from openai import OpenAI
+    return OpenAI(api_key=api_key, timeout=request_timeout(), max_retries=0)
+
 
 def summarize_abstract(abstract, api_key, model="gpt-3.5-turbo"):
     """
@@ -13,19 +21,21 @@ def summarize_abstract(abstract, api_key, model="gpt-3.5-turbo"):
 
     Returns:
         str: A shorter, concise version of the abstract.
+    Raises:
+        Exception: If the request still fails after retries.
     """
-    try:
-        client = OpenAI(api_key=api_key)
-
-        response = client.chat.completions.create(model=model,
-                        messages = [{"role": "system", "content": "You are a helpful assistant."},
-                                    {"role": "user", "content": f"Please summarize the following abstract in a short and concise way: {abstract}"},
-                                ])
-        return response.choices[0].message.content
-    except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        return None
-    
+    client = openai_client(api_key)
+
+    def create():
+        with api_call('openai', 'chat', model=model):
+            return client.chat.completions.create(model=model,
+                            messages = [{"role": "system", "content": "You are a helpful assistant."},
+                                        {"role": "user", "content": f"Please summarize the following abstract in a short and concise way: {abstract}"},
+                                    ])
+    response = call_with_retry('openai', 'chat', create)
+    record_openai_usage(model, response.usage)
+    return response.choices[0].message.content
+
 def convert_text_to_embedding(text: str, api_key: str, model:str="text-embedding-ada-002"):
     """
     Convert text into embeddings using the OpenAI GPT-3 API.
@@ -35,21 +45,43 @@ def convert_text_to_embedding(text: str, api_key: str, model:str="text-embedding
         api_key (str): Your OpenAI API key.
         model (str): The GPT-3 model to use
     Returns:
-        str: The generated text-based embedding.
+        list: The embedding of the text.
+    Raises:
+        Exception: If the request still fails after retries.
     Example:
-        >> embedding = convert_text_to_embedding(api_key, input_text)
+        >> embedding = convert_text_to_embedding(input_text, api_key)
     """
-    try:
-        client = OpenAI(api_key=api_key)
+    client = openai_client(api_key)
+
+    def create():
+        with api_call('openai', 'embeddings', model=model):
+            return client.embeddings.create(input=text, model=model)
+    response = call_with_retry('openai', 'embeddings', create)
+    record_openai_usage(model, response.usage)
+    return response.data[0].embedding
 
-        response = client.embeddings.create(
-            input=text,
-            model=model
-        )
 
-        embedding = response.data[0].embedding
+def convert_texts_to_embeddings(texts: list, api_key: str, model: str="text-embedding-ada-002") -> list:
+    """
+    Convert a batch of texts into embeddings with a single OpenAI API call.
+
+    Args:
+        texts (list): The texts to convert into embeddings.
+        api_key (str): Your OpenAI API key.
+        model (str): The embedding model to use.
+    Returns:
+        list: The embeddings, in the same order as the input texts.
+    Example:
+        >> embeddings = convert_texts_to_embeddings(["first text", "second text"], api_key)
+    """
+    if not texts:
+        return []
 
-        return embedding
+    client = openai_client(api_key)
 
-    except Exception as e:
-        return str(e)
\ No newline at end of file
+    def create():
+        with api_call('openai', 'embeddings', model=model, texts=len(texts)):
+            return client.embeddings.create(input=texts, model=model)
+    response = call_with_retry('openai', 'embeddings', create)
+    record_openai_usage(model, response.usage)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
@@ -0,0 +1,306 @@
+""" Full-text ingestion of the article PDFs.
+
+Downloads the PDFs of the articles in PostgreSQL, extracts and chunks their text, and adds the chunk embeddings to a
+separate Faiss index (`faiss_chunks/`) that can be queried like the abstract index:
+    python -m bot.pdf --limit 1000
+    python -m bot.embeddings --index-dir faiss_chunks query --text "transaction costs"
+
+The index is written as append-only shards (see `FaissDatabase.save_shard`): every save only writes the chunks added
+since the previous one, and only those are kept in memory. Runs are incremental: every ingested PDF is recorded in the
+state store once its chunks are saved, and later runs skip it, so an interrupted run resumes where it stopped. Failed
+downloads are retried by the next run.
+"""
+import os
+import re
+import time
+import logging
+import argparse
+import resource
+import threading
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from bot.embeddings import DEFAULT_EMBEDDING_DIM, FaissDatabase, batched, bounded_map
+from bot.metrics import BYTES_RECEIVED, STAGE_ITEMS, api_call
+from bot.state import DONE, FAILED, StateStore
+
+DEFAULT_CHUNK_INDEX_DIR = 'faiss_chunks'
+DEFAULT_PDF_DIR = './pdfs'
+# arXiv asks automated clients to wait a few seconds between requests
+DEFAULT_REQUEST_INTERVAL = 3.0
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024
+DEFAULT_CHUNK_WORDS = 300
+DEFAULT_CHUNK_OVERLAP = 50
+READ_SIZE = 64 * 1024
+USER_AGENT = 'arxiv-telegram-bot (PDF ingestion)'
+
+# PDFs over the size cap or without readable text are not downloaded again by later runs (failed downloads are)
+TOO_LARGE = 'too_large'
+UNREADABLE = 'unreadable'
+
+
+class Throttle:
+    """ Spaces the start of requests made from several threads at least `interval` seconds apart. Downloads still
+    overlap: a slow download does not hold back the start of the next one.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_start = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """ Block until the calling thread may start its request. """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def download_pdf(id: str, url: str, directory: str, throttle: Throttle, max_bytes: int = DEFAULT_MAX_BYTES,
+                 timeout: float = 60) -> Tuple[Optional[str], int, Optional[str]]:
+    """ Stream a PDF to disk in small blocks, so memory does not depend on its size. The file only appears under its
+    final name once it is complete.
+    Args:
+        id (str): The arXiv ID, used as the file name.
+        url (str): The URL of the PDF.
+        directory (str): Where the PDF is written.
+        throttle (Throttle): Shared by all downloads to respect the arXiv rate limit.
+        max_bytes (int): Downloads larger than this are abandoned.
+        timeout (float): Seconds to wait for the server.
+    Returns:
+        tuple: The path of the PDF (None if the download failed), the number of bytes received, and the failure status
+            (None, `TOO_LARGE` or `FAILED`).
+    """
+    path = os.path.join(directory, f"{id.replace('/', '_')}.pdf")
+    tmp_path = f"{path}.part"
+    size, too_large = 0, False
+    throttle.wait()
+    try:
+        request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+        with api_call('arxiv', 'pdf'), urllib.request.urlopen(request, timeout=timeout) as response:
+            length = response.headers.get('Content-Length')
+            too_large = length is not None and int(length) > max_bytes
+            if not too_large:
+                with open(tmp_path, 'wb') as file:
+                    while block := response.read(READ_SIZE):
+                        size += len(block)
+                        if size > max_bytes:
+                            too_large = True
+                            break
+                        file.write(block)
+        BYTES_RECEIVED.inc(size, service='arxiv')
+    except Exception as e:
+        logging.error(f"Could not download the PDF of {id}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, size, FAILED
+
+    if too_large:
+        logging.warning(f"The PDF of {id} is larger than {max_bytes} bytes. Skipping it.")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None, size, TOO_LARGE
+    os.replace(tmp_path, path)
+    return path, size, None
+
+
+def chunk_text(text: str, chunk_words: int = DEFAULT_CHUNK_WORDS, overlap: int = DEFAULT_CHUNK_OVERLAP) -> List[str]:
+    """ Split a text into chunks of `chunk_words` words, each overlapping the previous one by `overlap` words. """
+    words = text.split()
+    step = max(1, chunk_words - overlap)
+    return [' '.join(words[i:i + chunk_words]) for i in range(0, max(len(words) - overlap, 1), step) if words[i:i + chunk_words]]
+
+
+def extract_chunks(task: tuple) -> Tuple[str, Optional[List[str]]]:
+    """ Extract the text of a PDF and split it into chunks (run in a worker process).
+    Args:
+        task (tuple): (id, path, chunk_words, overlap).
+    Returns:
+        tuple: The ID and the chunks, or None if the PDF could not be read.
+    """
+    from PyPDF2 import PdfReader
+
+    id, path, chunk_words, overlap = task
+    try:
+        reader = PdfReader(path)
+        text = '\n'.join(page.extract_text() or '' for page in reader.pages)
+    except Exception as e:
+        logging.error(f"Could not extract the text of {id}: {e}")
+        return id, None
+    # undo the hyphenation of words broken across lines
+    text = re.sub(r'(\w)-\n(\w)', r'\1\2', text)
+    return id, chunk_text(text, chunk_words, overlap)
+
+
+def embed_chunks(chunks: List[str], api_key: str, batch_size: int = 100):
+    """ Embed the chunks of a document, `batch_size` chunks per request, and normalize them to unit length. """
+    import numpy as np
+    from bot.openai import convert_texts_to_embeddings
+
+    vectors = []
+    for batch in batched(chunks, batch_size):
+        vectors.extend(convert_texts_to_embeddings(batch, api_key))
+    return FaissDatabase.normalize_embeddings(np.asarray(vectors, dtype=np.float32))
+
+
+def peak_rss_mb() -> Tuple[float, float]:
+    """ Peak resident memory (in MB) of this process and of its largest finished worker process. """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+class IngestStats:
+    """ Counts what an ingestion run has done and reports its throughput and memory. """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.documents = 0
+        self.failed = 0
+        self.chunks = 0
+        self.bytes = 0
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rss, worker_rss = peak_rss_mb()
+        return (f"{self.documents} PDFs ingested, {self.failed} failed, {self.chunks} chunks, "
+                f"{self.bytes / 1024 / 1024:.1f} MB in {elapsed:.0f} s "
+                f"({self.documents / elapsed if elapsed else 0:.2f} PDFs/s, "
+                f"{self.bytes / 1024 / 1024 / elapsed if elapsed else 0:.2f} MB/s), "
+                f"peak RSS {rss:.0f} MB (workers {worker_rss:.0f} MB)")
+
+
+def ingest_pdfs(rows: Iterable[tuple], store: StateStore, api_key: str, index_dir: str,
+                embedding_dim: int = DEFAULT_EMBEDDING_DIM, pdf_dir: str = DEFAULT_PDF_DIR, workers: int = 4,
+                processes: int = 2, interval: float = DEFAULT_REQUEST_INTERVAL, max_bytes: int = DEFAULT_MAX_BYTES,
+                chunk_words: int = DEFAULT_CHUNK_WORDS, overlap: int = DEFAULT_CHUNK_OVERLAP, batch_size: int = 100,
+                save_every: int = 100, keep_pdfs: bool = False) -> IngestStats:
+    """ Download, extract, chunk and embed the PDFs of (id, title, pdf_link) rows into a chunk index.
+
+    The stages run concurrently: PDFs are downloaded by a thread pool (starting at most one download every `interval`
+    seconds), their text is extracted in a process pool, and the chunks are embedded by a second thread pool. Every
+    stage has a bounded number of items in flight.
+
+    Chunks are added to a shard of the index as `<id>#<n>` with the article title. Every `save_every` PDFs the shard is
+    saved into `index_dir` and a new one is started, and only then are the PDFs recorded as done in the state store.
+    Memory therefore depends on `save_every`, not on the number of rows, and every chunk is written once.
+    Returns:
+        IngestStats: What the run has done.
+    """
+    os.makedirs(pdf_dir, exist_ok=True)
+    throttle = Throttle(interval)
+    stats = IngestStats()
+    # titles and sizes of the documents in flight, and the documents waiting for the next save of the index
+    titles, sizes, unsaved, saved = {}, {}, [], 0
+    shard = FaissDatabase(embedding_dim, store_embeddings=False)
+
+    def download(row):
+        id, title, url = row
+        titles[id] = title
+        path, size, error = download_pdf(id, url, pdf_dir, throttle, max_bytes)
+        return id, path, size, error
+
+    def embed(document):
+        """ Embed the chunks of a document. A failed request only fails its document (vectors are None). """
+        id, chunks = document
+        if not chunks:
+            return id, chunks, None
+        try:
+            return id, chunks, embed_chunks(chunks, api_key, batch_size)
+        except Exception as e:
+            logging.error(f"Failed to embed {id}, it will be retried by the next run: {e}")
+            return id, chunks, None
+
+    def save() -> None:
+        nonlocal shard
+        if shard.ids:
+            shard.save_shard(index_dir)
+            shard = FaissDatabase(embedding_dim, store_embeddings=False)
+        store.record_documents(unsaved)
+        unsaved.clear()
+        logging.info(stats.report())
+
+    def extraction_tasks(downloads: Iterator) -> Iterator[tuple]:
+        for id, path, size, error in downloads:
+            stats.bytes += size
+            if error is not None:
+                stats.failed += 1
+                store.record_documents([(id, error, 0, size)])
+                titles.pop(id, None)
+                continue
+            sizes[id] = size
+            yield id, path, chunk_words, overlap
+
+    with ThreadPoolExecutor(workers) as downloaders, ProcessPoolExecutor(processes) as extractors, \
+            ThreadPoolExecutor(workers) as embedders:
+        downloads = bounded_map(downloaders, download, rows, 2 * workers)
+        documents = bounded_map(extractors, extract_chunks, extraction_tasks(downloads), 2 * processes)
+        for id, chunks, vectors in bounded_map(embedders, embed, documents, 2 * workers):
+            title, size = titles.pop(id, ''), sizes.pop(id, 0)
+            if not keep_pdfs:
+                os.remove(os.path.join(pdf_dir, f"{id.replace('/', '_')}.pdf"))
+            # a PDF without any extractable text (e.g. a scan) is not worth downloading again
+            if not chunks:
+                unsaved.append((id, UNREADABLE, 0, size))
+                stats.failed += 1
+                continue
+            if vectors is None:
+                unsaved.append((id, FAILED, 0, size))
+                stats.failed += 1
+                continue
+            shard.add_vectors([f"{id}#{i}" for i in range(len(chunks))], [title] * len(chunks), chunks, vectors)
+            unsaved.append((id, DONE, len(chunks), size))
+            stats.documents += 1
+            stats.chunks += len(chunks)
+            STAGE_ITEMS.inc(stage='pdf')
+            if stats.documents - saved >= save_every:
+                saved = stats.documents
+                save()
+    save()
+    return stats
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Ingest the full text of the article PDFs into a chunk index.')
+    parser.add_argument('--index-dir', default=DEFAULT_CHUNK_INDEX_DIR, help='Directory of the chunk index.')
+    parser.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help='Embedding dimension.')
+    parser.add_argument('--pdf-dir', default=DEFAULT_PDF_DIR, help='Where the PDFs are downloaded.')
+    parser.add_argument('--keep-pdfs', action='store_true', help='Keep the PDFs once their text is extracted.')
+    parser.add_argument('--limit', type=int, help='Ingest at most this many PDFs.')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent downloads and embedding requests.')
+    parser.add_argument('--processes', type=int, default=2, help='Processes extracting the text.')
+    parser.add_argument('--interval', type=float, default=DEFAULT_REQUEST_INTERVAL, help='Seconds between the start of two downloads.')
+    parser.add_argument('--max-mb', type=float, default=DEFAULT_MAX_BYTES / 1024 / 1024, help='Size cap of a PDF in MB.')
+    parser.add_argument('--chunk-words', type=int, default=DEFAULT_CHUNK_WORDS, help='Words per chunk.')
+    parser.add_argument('--overlap', type=int, default=DEFAULT_CHUNK_OVERLAP, help='Words shared by consecutive chunks.')
+    parser.add_argument('--batch-size', type=int, default=100, help='Chunks per embedding request.')
+    parser.add_argument('--save-every', type=int, default=100, help='PDFs per shard of the index.')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from itertools import islice
+    from dotenv import load_dotenv
+    from bot.database import PostgresHandler
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s')
+    args = parse_args(argv)
+
+    store = StateStore()
+    handler = PostgresHandler()
+    try:
+        skip = store.document_ids([DONE, TOO_LARGE, UNREADABLE])
+        rows = (row for row in handler.stream_rows(columns=('id', 'title', 'pdf_link')) if row[2] and row[0] not in skip)
+        stats = ingest_pdfs(islice(rows, args.limit), store, os.getenv('OPENAI_TOKEN'), args.index_dir, args.dim,
+                            args.pdf_dir, args.workers, args.processes, args.interval, int(args.max_mb * 1024 * 1024),
+                            args.chunk_words, args.overlap, args.batch_size, args.save_every, args.keep_pdfs)
+    finally:
+        handler.close_connection()
+        store.close()
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 import os
 import asyncio
 import logging
-from openai import OpenAI
-from telegram import Bot
 from datetime import datetime
+from typing import Optional
+
+from bot.metrics import api_call
+from bot.openai import summarize_abstract
+from bot.resilience import call_with_retry, is_transient, is_unsent, request_timeout
 
 class TelegramPost:
     """ A class for formatting a post for Telegram. """
@@ -24,7 +27,7 @@ class TelegramPost:
 
     def check_env_variables(self):
         """ Checks if required environment variables are set. """
-        required_env_vars = ['OPENAI_TOKEN', 'BOT_TOKEN', 'CHANNEL_ID']
+        required_env_vars = ['OPENAI_TOKEN', 'BOT_TOKEN']
         all_vars_present = True
 
         for var in required_env_vars:
@@ -50,23 +53,11 @@ class TelegramPost:
 
     def summarize_abstract(self, api_key, model="gpt-3.5-turbo"):
         """ Rewrites an abstract to be short and concise using OpenAI's GPT chat model.
+        Raises if OpenAI still fails after retries, so that the article is retried by the next run.
         """
-        try:
-            client = OpenAI(api_key=api_key)
-
-            response = client.chat.completions.create(
-                model=model,
-                messages = [
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": f"Please summarize the following abstract in a short and concise way: {self.article_info['summary']}"}
-                ]
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.error(f"An error occurred: {e}")
-            return None
+        return summarize_abstract(self.article_info['summary'], api_key, model)
 
-    def format_post(self):
+    def format_post(self, hashtag: str = 'finarxiv'):
         """ Prepare the message for posting """
         published = self.format_datetime()
 
@@ -81,20 +72,47 @@ class TelegramPost:
                   f"👥 *Authors:* {authors} \n\n" \
                   f"🔍 *Abstract:*\n{abstract}\n\n" \
                   f"🧠 *AI Summary:*\n{ai_summary}\n\n" \
-                  f"#finarxiv \n\n" \
+                  f"#{hashtag} \n\n" \
                   f"Published on arXiv: {published}\n" \
                   f"🔗 [Read More]({link})"
         
         return message
     
-    async def send_message_to_channel(self):
-        """ Async function to send a message to the specified Telegram channel """
-        if os.getenv('BOT_TOKEN') and os.getenv('CHANNEL_ID'):
-            bot = Bot(token=os.getenv('BOT_TOKEN'),)
-            await bot.send_message(chat_id=os.getenv('CHANNEL_ID'), text=self.message, parse_mode='Markdown')
+    async def send_message_to_channel(self, channel_id: Optional[str] = None, message: Optional[str] = None,
+                                      reply_to_message_id: Optional[int] = None):
+        """ Async function to send a message to the specified Telegram channel (defaults to `CHANNEL_ID`),
+        optionally as a reply to an earlier message. Returns the sent message, or None.
+        """
+        channel_id = channel_id or os.getenv('CHANNEL_ID')
+        if os.getenv('BOT_TOKEN') and channel_id:
+            from telegram import Bot
+            bot = Bot(token=os.getenv('BOT_TOKEN'), base_url=os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot'))
+            timeout = request_timeout()
+            with api_call('telegram', 'send_message', channel=channel_id):
+                return await bot.send_message(chat_id=channel_id, text=message or self.message, parse_mode='Markdown',
+                                              reply_to_message_id=reply_to_message_id, read_timeout=timeout,
+                                              write_timeout=timeout, connect_timeout=timeout)
         else:
             logging.error("Bot token or channel ID environment variables not provided.")
 
-    def post_to_channel(self):
-        """ Posting the message to the Telegram channel """
-        asyncio.run(self.send_message_to_channel())
\ No newline at end of file
+    def post_to_channel(self, channel_id: Optional[str] = None, hashtag: Optional[str] = None,
+                        reply_to_message_id: Optional[int] = None) -> Optional[int]:
+        """ Posting the message to a Telegram channel. The AI summary is computed once, so the same post can be
+        sent to several channels, each with its own hashtag. Near-duplicates can be threaded below the original post
+        with `reply_to_message_id`. Rate limits and connection errors are retried. Returns the ID of the sent message,
+        or None.
+
+        A message is never sent twice: after a read or write timeout Telegram may already have posted it, so it is
+        neither retried nor reported as failed (which would make the next run post it again).
+        """
+        message = self.format_post(hashtag) if hashtag else self.message
+        try:
+            sent = call_with_retry('telegram', 'send_message', lambda: asyncio.run(
+                self.send_message_to_channel(channel_id, message, reply_to_message_id)), retry_if=is_unsent)
+        except Exception as e:
+            if not is_transient(e) or is_unsent(e):
+                raise
+            logging.warning(f"Sending to {channel_id} timed out ({type(e).__name__}: {e}). The message may have been "
+                            f"posted, so it is not sent again.")
+            return None
+        return sent.message_id if sent is not None else None
\ No newline at end of file
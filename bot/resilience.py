@@ -0,0 +1,195 @@
+""" Timeouts, retries and circuit breakers for the calls to external services (arXiv, OpenAI and Telegram).
+
+Transient failures (timeouts, dropped connections, truncated responses, rate limits and server errors) are retried
+with jittered exponential backoff. Every service has a circuit breaker: after repeated transient failures the service
+is not called for a while, so a run fails fast instead of waiting for a service that is down.
+Example:
+    >>> response = call_with_retry('arxiv', 'list', lambda: urlopen(url, timeout=request_timeout()).read())
+"""
+import os
+import sys
+import time
+import random
+import socket
+import logging
+import threading
+import http.client
+import urllib.error
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, Optional, TypeVar
+
+from bot.metrics import API_RETRIES
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_ATTEMPTS = 3
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60.0
+
+T = TypeVar('T')
+
+
+def request_timeout() -> float:
+    """ Seconds to wait for an external service, from `HTTP_TIMEOUT` (30 by default). """
+    return float(os.getenv('HTTP_TIMEOUT', DEFAULT_TIMEOUT))
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling a service whose circuit breaker is open. """
+
+
+class CircuitBreaker:
+    """ Stops calling a service after `failure_threshold` consecutive transient failures.
+
+    Once open, calls fail immediately for `reset_timeout` seconds. Then a single trial call is let through
+    (half-open): if it succeeds the circuit closes again, otherwise it stays open for another `reset_timeout`.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, service: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """ Whether the service may be called now. """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """ Record a call that reached the service. """
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info(f"The circuit of {self.service} is closed again.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        """ Record a transient failure, opening the circuit if there are too many in a row. """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.error(f"The circuit of {self.service} is open after {self.failures} failures.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(service: str) -> CircuitBreaker:
+    """ Return the circuit breaker of a service (shared by all calls to it within the process). """
+    with _breakers_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service)
+        return _breakers[service]
+
+
+def is_transient(error: BaseException) -> bool:
+    """ Whether a failed call is worth retrying: timeouts, connection errors, truncated or malformed responses, rate
+    limits and server errors are; client errors (e.g. a bad request or a wrong token) are not.
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    # before Python 3.10, socket.timeout (raised by read timeouts) is not a TimeoutError
+    if isinstance(error, (urllib.error.URLError, socket.timeout, TimeoutError, ConnectionError, http.client.HTTPException,
+                          ET.ParseError)):
+        return True
+    # OpenAI and Telegram errors are only checked if those clients have been imported
+    openai = sys.modules.get('openai')
+    if openai is not None and isinstance(error, (openai.APIConnectionError, openai.RateLimitError,
+                                                 openai.InternalServerError)):
+        return True
+    telegram_error = sys.modules.get('telegram.error')
+    if telegram_error is not None:
+        if isinstance(error, telegram_error.RetryAfter):
+            return True
+        if isinstance(error, telegram_error.NetworkError) and not isinstance(error, telegram_error.BadRequest):
+            return True
+    return False
+
+
+def is_unsent(error: BaseException) -> bool:
+    """ Whether a failed call certainly never reached the service: it asked to be retried later, or no connection
+    could be made. Calls that must not be repeated (e.g. sending a message) are only retried on these errors, since after
+    a read or write timeout the service may already have acted on the request.
+    """
+    if isinstance(error, ConnectionRefusedError):
+        return True
+    telegram_error = sys.modules.get('telegram.error')
+    if telegram_error is not None and isinstance(error, telegram_error.RetryAfter):
+        return True
+    # python-telegram-bot raises its network errors from the underlying httpx error
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def backoff_delay(attempt: int, error: Optional[BaseException] = None, base_delay: float = DEFAULT_BASE_DELAY,
+                  max_delay: float = DEFAULT_MAX_DELAY) -> float:
+    """ Seconds to wait before retrying: the delay a rate-limited service asks for, or otherwise a random delay of
+    up to `base_delay * 2 ** attempt` ("full jitter"), so that clients failing together do not retry together.
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None and isinstance(error, urllib.error.HTTPError) and error.headers is not None:
+        retry_after = error.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return min(max_delay, float(getattr(retry_after, 'total_seconds', lambda: retry_after)()))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retry(service: str, operation: str, function: Callable[[], T], attempts: int = DEFAULT_ATTEMPTS,
+                    base_delay: float = DEFAULT_BASE_DELAY, max_delay: float = DEFAULT_MAX_DELAY,
+                    retry_if: Callable[[BaseException], bool] = is_transient) -> T:
+    """ Call `function` (without arguments) and retry it on transient failures, through the circuit breaker of the
+    service. Retries are counted in `API_RETRIES`.
+    Args:
+        service (str): The service called, e.g. 'openai'.
+        operation (str): The operation, e.g. 'chat'.
+        function (callable): The call to make.
+        attempts (int): The maximum number of calls.
+        base_delay (float): The maximum delay before the first retry; it doubles with every retry.
+        max_delay (float): The maximum delay before a retry.
+        retry_if (callable): Which transient errors are retried, e.g. `is_unsent` for calls that must not be repeated.
+    Returns:
+        The result of `function`.
+    Raises:
+        CircuitOpenError: If the circuit of the service is open.
+        Exception: The last error if all attempts failed, or the first error that is not transient.
+    """
+    breaker = get_breaker(service)
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise CircuitOpenError(f"Not calling {service} ({operation}): too many failures in a row.")
+        try:
+            result = function()
+        except Exception as e:
+            if not is_transient(e):
+                # the service did answer, so it is up
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if not retry_if(e) or attempt + 1 == attempts or breaker.state == CircuitBreaker.OPEN:
+                raise
+            delay = backoff_delay(attempt, e, base_delay, max_delay)
+            API_RETRIES.inc(service=service, operation=operation)
+            logging.warning(f"{service} {operation} failed ({type(e).__name__}: {e}). Retrying in {delay:.1f} s...")
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
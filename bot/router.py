@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from bot.metrics import stage
+from bot.openai import convert_texts_to_embeddings
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_CATEGORY = 'q-fin.PM'
+DEFAULT_HASHTAG = 'finarxiv'
+
+
+class ChannelProfile:
+    """ Routing rules of a single Telegram channel. """
+    def __init__(self, channel_id: str, categories: Optional[List[str]] = None, keywords: Optional[List[str]] = None,
+                 topics: Optional[List[str]] = None, threshold: float = 0.8, hashtag: str = DEFAULT_HASHTAG):
+        """ Initialize the channel profile.
+        Args:
+            channel_id (str): The ID of the Telegram channel.
+            categories (list): arXiv categories the channel follows. An empty list accepts every category.
+            keywords (list): Regular expressions matched (case-insensitive) against the title and abstract. A paper
+                must match at least one of them. An empty list accepts every paper.
+            topics (list): Free-text topic descriptions. A paper must have a cosine similarity of at least
+                `threshold` with one of them. An empty list accepts every paper.
+            threshold (float): The cosine similarity threshold for the topic filter.
+            hashtag (str): The hashtag appended to the channel's posts.
+        """
+        if not channel_id:
+            logging.error("Channel profile without a channel ID.")
+            raise ValueError("Channel profile without a channel ID.")
+
+        self.channel_id = channel_id
+        self.categories = list(categories or [])
+        self.keywords = list(keywords or [])
+        self.keyword_pattern = re.compile('|'.join(f'(?:{k})' for k in self.keywords), re.IGNORECASE) if self.keywords else None
+        self.topics = list(topics or [])
+        self.threshold = threshold
+        self.hashtag = hashtag
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """ Create a channel profile from its dictionary representation (as stored in the channels config). """
+        return cls(channel_id=data.get('channel_id'),
+                   categories=data.get('categories'),
+                   keywords=data.get('keywords'),
+                   topics=data.get('topics'),
+                   threshold=data.get('threshold', 0.8),
+                   hashtag=data.get('hashtag', DEFAULT_HASHTAG))
+
+
+def load_channel_profiles(filepath: Optional[str] = None) -> List[ChannelProfile]:
+    """ Load the channel profiles from a JSON file.
+
+    The file contains a list of profiles, e.g.
+    `[{"channel_id": "@finarxiv", "categories": ["q-fin.PM"], "keywords": ["portfolio"], "hashtag": "finarxiv"}]`.
+    Without a config file, a single profile is built from the `CHANNEL_ID` environment variable.
+    Args:
+        filepath (str): Path to the channels config. Defaults to the `CHANNELS_CONFIG` environment variable.
+    Returns:
+        list: The channel profiles.
+    """
+    filepath = filepath or os.getenv('CHANNELS_CONFIG')
+    if not filepath:
+        return [ChannelProfile(os.getenv('CHANNEL_ID'), categories=[DEFAULT_CATEGORY])]
+
+    with open(filepath, 'r') as file:
+        profiles = [ChannelProfile.from_dict(data) for data in json.load(file)]
+    logging.info(f"Loaded {len(profiles)} channel profiles from {filepath}")
+    return profiles
+
+
+class ChannelRouter:
+    """ Routes papers to the channels whose filters they match. """
+    def __init__(self, profiles: List[ChannelProfile], api_key: Optional[str] = None):
+        """ Initialize the router.
+        Args:
+            profiles (list): The channel profiles.
+            api_key (str): OpenAI API key, only needed if a profile uses topic filters.
+        """
+        if not profiles:
+            logging.error("At least one channel profile is required.")
+            raise ValueError("At least one channel profile is required.")
+
+        self.profiles = profiles
+        self.api_key = api_key or os.getenv('OPENAI_TOKEN')
+        self._topic_embeddings = None
+
+    @property
+    def categories(self) -> List[str]:
+        """ All categories that have to be fetched (each of them once). """
+        categories = sorted({category for profile in self.profiles for category in profile.categories})
+        return categories or [DEFAULT_CATEGORY]
+
+    def match_categories(self, metadata: list, listed_in: Dict[str, set]) -> 'np.ndarray':
+        """ Compute a (papers x profiles) boolean matrix of category matches.
+        Args:
+            metadata (list): Metadata of the papers.
+            listed_in (dict): Maps paper IDs to the listings (categories) they were found in.
+        Returns:
+            np.ndarray: Boolean match matrix.
+        """
+        import numpy as np
+
+        vocabulary = {category: i for i, category in enumerate(self.categories)}
+        papers = np.zeros((len(metadata), len(vocabulary)), dtype=np.float32)
+        for i, item in enumerate(metadata):
+            for category in listed_in.get(item['id'], set()) | {item.get('arxiv_primary_category')}:
+                if category in vocabulary:
+                    papers[i, vocabulary[category]] = 1
+
+        profiles = np.zeros((len(self.profiles), len(vocabulary)), dtype=np.float32)
+        for j, profile in enumerate(self.profiles):
+            profiles[j, [vocabulary[category] for category in profile.categories]] = 1
+
+        match = (papers @ profiles.T) > 0
+        match[:, [not profile.categories for profile in self.profiles]] = True
+        return match
+
+    def match_keywords(self, metadata: list) -> 'np.ndarray':
+        """ Compute a (papers x profiles) boolean matrix of keyword matches. """
+        import numpy as np
+
+        texts = [f"{item['title']} {item['summary']}" for item in metadata]
+        match = np.ones((len(metadata), len(self.profiles)), dtype=bool)
+        for j, profile in enumerate(self.profiles):
+            if profile.keyword_pattern is not None:
+                match[:, j] = [profile.keyword_pattern.search(text) is not None for text in texts]
+        return match
+
+    def topic_embeddings(self):
+        """ Embed the topics of all profiles once and cache them.
+        Returns:
+            tuple: Normalized topic embeddings (topics x dim) and the profile index of each topic.
+        """
+        import numpy as np
+        from bot.embeddings import FaissDatabase
+
+        if self._topic_embeddings is None:
+            topics = [(j, topic) for j, profile in enumerate(self.profiles) for topic in profile.topics]
+            owners = np.array([j for j, _ in topics], dtype=np.int64)
+            embeddings = FaissDatabase.normalize_embeddings(np.array(convert_texts_to_embeddings([t for _, t in topics], self.api_key), dtype=np.float32))
+            self._topic_embeddings = (embeddings, owners)
+        return self._topic_embeddings
+
+    def match_topics(self, metadata: list) -> 'np.ndarray':
+        """ Compute a (papers x profiles) boolean matrix of topic matches with one matrix product over all papers and
+        all topics. Paper embeddings are requested in a single batch, and only if a profile uses topic filters.
+        """
+        import numpy as np
+        from bot.embeddings import FaissDatabase
+
+        match = np.ones((len(metadata), len(self.profiles)), dtype=bool)
+        if not any(profile.topics for profile in self.profiles):
+            return match
+
+        topic_embeddings, owners = self.topic_embeddings()
+        texts = [f"{item['title']} {item['summary']}".replace('\n', ' ') for item in metadata]
+        with stage('embedding'):
+            paper_embeddings = FaissDatabase.normalize_embeddings(np.array(convert_texts_to_embeddings(texts, self.api_key), dtype=np.float32))
+
+        similarities = paper_embeddings @ topic_embeddings.T
+        thresholds = np.array([self.profiles[j].threshold for j in owners], dtype=np.float32)
+        hits = similarities >= thresholds
+        for j, profile in enumerate(self.profiles):
+            if profile.topics:
+                match[:, j] = hits[:, owners == j].any(axis=1)
+        return match
+
+    def route(self, metadata: list, listed_in: Optional[Dict[str, set]] = None,
+              topics: bool = True) -> Dict[str, List[ChannelProfile]]:
+        """ Decide which channels each paper is posted to.
+        Args:
+            metadata (list): Metadata of the papers.
+            listed_in (dict): Maps paper IDs to the listings (categories) they were found in.
+            topics (bool): Whether to apply the topic filters. Without them (e.g. if the papers cannot be embedded),
+                no paper is routed to a channel with topic filters.
+        Returns:
+            dict: Maps paper IDs to the profiles of the channels the paper is posted to.
+        """
+        if not metadata:
+            return {}
+
+        import numpy as np
+
+        match = self.match_categories(metadata, listed_in or {})
+        match &= self.match_keywords(metadata)
+        # only papers that passed the cheap filters are embedded
+        if not topics:
+            match[:, [bool(profile.topics) for profile in self.profiles]] = False
+        candidates = np.flatnonzero(match.any(axis=1))
+        if topics and candidates.size:
+            match[candidates] &= self.match_topics([metadata[i] for i in candidates])
+
+        routes = {item['id']: [self.profiles[j] for j in np.flatnonzero(match[i])] for i, item in enumerate(metadata)}
+        logging.info(f"Routed {int(match.sum())} posts to {len(self.profiles)} channels.")
+        return routes
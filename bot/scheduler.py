@@ -0,0 +1,72 @@
+import logging
+from datetime import datetime, timedelta, time as dtime
+from typing import Optional, Tuple
+
+import pytz
+from apscheduler.triggers.base import BaseTrigger
+
+# arXiv announces new submissions Sunday through Thursday at 20:00 US Eastern time
+ARXIV_TIMEZONE = pytz.timezone('US/Eastern')
+ANNOUNCEMENT_WEEKDAYS = (6, 0, 1, 2, 3)
+ANNOUNCEMENT_TIME = dtime(20, 0)
+
+
+def announcement_window(moment: datetime, lead: timedelta = timedelta(minutes=5),
+                        duration: timedelta = timedelta(hours=2)) -> Tuple[datetime, datetime]:
+    """ Compute the arXiv announcement window that contains the given moment, or the next one if the moment
+    falls outside of any window.
+    Args:
+        moment (datetime): A timezone-aware point in time.
+        lead (timedelta): How long before the announcement the window opens.
+        duration (timedelta): How long after the announcement the window stays open.
+    Returns:
+        tuple: The opening and closing times of the window as timezone-aware datetimes (US/Eastern).
+    Example:
+        >>> start, end = announcement_window(datetime.now(pytz.utc))
+    """
+    local = moment.astimezone(ARXIV_TIMEZONE)
+    for days in range(8):
+        day = local.date() + timedelta(days=days)
+        if day.weekday() not in ANNOUNCEMENT_WEEKDAYS:
+            continue
+        announcement = ARXIV_TIMEZONE.localize(datetime.combine(day, ANNOUNCEMENT_TIME))
+        start, end = announcement - lead, announcement + duration
+        if end > moment:
+            return start, end
+    raise RuntimeError("Could not find the next arXiv announcement window.")
+
+
+class AnnouncementTrigger(BaseTrigger):
+    """ An APScheduler trigger that polls densely around arXiv's announcement time and backs off otherwise.
+
+    The first fire happens immediately so that a freshly started bot catches up on anything it missed. Inside
+    an announcement window the job fires every `interval`; outside of it the trigger sleeps until the next
+    window opens, but never longer than `max_backoff` (a safety net for holidays and schedule changes).
+    """
+    def __init__(self, interval: timedelta = timedelta(minutes=2), lead: timedelta = timedelta(minutes=5),
+                 duration: timedelta = timedelta(hours=2), max_backoff: timedelta = timedelta(hours=6)):
+        self.interval = interval
+        self.lead = lead
+        self.duration = duration
+        self.max_backoff = max_backoff
+
+    def get_next_fire_time(self, previous_fire_time: Optional[datetime], now: datetime) -> Optional[datetime]:
+        """ Return the next time the job should fire (called by APScheduler). """
+        if previous_fire_time is None:
+            return now
+
+        dense = previous_fire_time + self.interval
+        start, _ = announcement_window(dense, self.lead, self.duration)
+        if dense >= start:
+            return dense
+
+        next_fire_time = min(start, previous_fire_time + self.max_backoff)
+        logging.info(f"Outside of the arXiv announcement window, next poll at {next_fire_time}.")
+        return next_fire_time
+
+    def __str__(self):
+        return f"announcement[interval={self.interval}, window={self.duration}, max_backoff={self.max_backoff}]"
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__} (interval={self.interval!r}, lead={self.lead!r}, "
+                f"duration={self.duration!r}, max_backoff={self.max_backoff!r})>")
@@ -0,0 +1,212 @@
+import os
+import asyncio
+import logging
+import functools
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
+
+from bot.cache import LRUCache
+from bot.dedup import strip_version
+from bot.metrics import SEARCH_BATCH_SIZE
+
+if TYPE_CHECKING:
+    from bot.database import PostgresPool
+    from bot.embeddings import FaissDatabase
+
+DEFAULT_CACHE_SIZE = 1024
+# results of the filters change as new articles are inserted, so cached results expire
+DEFAULT_CACHE_TTL = 300
+DEFAULT_BATCH_WINDOW = 0.002
+DEFAULT_MAX_BATCH = 64
+
+
+class Batcher:
+    """ Groups concurrent calls into batches. Items submitted within `window` seconds of the first pending one (at
+    most `max_batch`) are passed together to `function`, which runs in a worker thread and returns one result per item.
+    Example:
+        >>> batcher = Batcher(lambda texts: [len(text) for text in texts])
+        >>> await asyncio.gather(batcher.submit('a'), batcher.submit('bc'))
+        [1, 2]
+    """
+    def __init__(self, function: Callable[[list], list], window: float = DEFAULT_BATCH_WINDOW,
+                 max_batch: int = DEFAULT_MAX_BATCH, name: str = 'batch'):
+        self.function = function
+        self.window = window
+        self.max_batch = max_batch
+        self.name = name
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def submit(self, item):
+        """ Add an item to the next batch and wait for its result. """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        """ Start processing the pending items as one batch. """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch: list) -> None:
+        """ Process a batch in a worker thread and hand every caller its result (or the error). """
+        SEARCH_BATCH_SIZE.observe(len(batch), operation=self.name)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(None, self.function, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class SearchEngine:
+    """ Answers similar-paper, semantic and filter queries from a vector index and a Postgres pool kept in memory.
+
+    Concurrent kNN queries share one Faiss call, concurrent free-text queries one embedding request and concurrent
+    article lookups one database query (see `Batcher`). Query embeddings and results are kept in LRU caches.
+    """
+    def __init__(self, index: 'FaissDatabase', pool: Optional['PostgresPool'] = None, api_key: Optional[str] = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE, cache_ttl: Optional[float] = DEFAULT_CACHE_TTL,
+                 window: float = DEFAULT_BATCH_WINDOW, max_batch: int = DEFAULT_MAX_BATCH):
+        """
+        Args:
+            index (FaissDatabase): The vector index of the articles.
+            pool (PostgresPool): The database the article details and filters are read from. Without it, results only
+                have the ID and title stored in the index and `filter` is not available.
+            api_key (str): The OpenAI API key. Defaults to the `OPENAI_TOKEN` environment variable.
+            cache_size (int): The number of cached results and of cached query embeddings.
+            cache_ttl (float): The number of seconds a result stays cached.
+            window (float): How long (in seconds) a query waits for others to share its batch.
+            max_batch (int): The maximum number of queries per batch.
+        """
+        self.index = index
+        self.pool = pool
+        self.api_key = api_key or os.getenv('OPENAI_TOKEN')
+        self.results = LRUCache(cache_size, ttl=cache_ttl, name='results')
+        self.embeddings = LRUCache(cache_size, name='embeddings')
+        self.knn = Batcher(self._search_batch, window, max_batch, name='faiss_search')
+        self.embedder = Batcher(self._embed_batch, window, max_batch, name='embeddings')
+        self.fetcher = Batcher(self._fetch_batch, window, max_batch, name='fetch_articles')
+
+    def reload(self, index: 'FaissDatabase') -> None:
+        """ Swap in a new vector index (e.g. after `python -m bot.embeddings update-index`) and drop cached results. """
+        self.index = index
+        self.results.clear()
+        logging.info(f"Search index reloaded with {len(index.ids)} articles.")
+
+    async def similar(self, arxiv_id: str, k: int = 10) -> List[dict]:
+        """ Find the k articles most similar to an indexed article.
+        Raises:
+            KeyError: If the article is not in the index.
+        """
+        import numpy as np
+
+        arxiv_id = strip_version(arxiv_id)
+        key = ('similar', arxiv_id, k)
+        results = self.results.get(key)
+        if results is None:
+            position = self.index.find_index_by_id(arxiv_id)
+            if position < 0:
+                raise KeyError(arxiv_id)
+            vector = self.index.normalize_embeddings(np.asarray(self.index.get_embedding(position),
+                                                                dtype='float32').reshape(1, -1))[0]
+            neighbours = await self.knn.submit((vector, k + 1))
+            results = await self._with_articles([(id, score) for id, score in neighbours if id != arxiv_id][:k])
+            self.results.put(key, results)
+        return results
+
+    async def search(self, text: str, k: int = 10) -> List[dict]:
+        """ Find the k articles whose abstracts are semantically closest to a free-text query. """
+        text = ' '.join(text.split())
+        key = ('search', text, k)
+        results = self.results.get(key)
+        if results is None:
+            vector = self.embeddings.get(text)
+            if vector is None:
+                vector = await self.embedder.submit(text)
+                self.embeddings.put(text, vector)
+            results = await self._with_articles(await self.knn.submit((vector, k)))
+            self.results.put(key, results)
+        return results
+
+    async def filter(self, keywords: Sequence[str] = (), since: Optional[str] = None, until: Optional[str] = None,
+                     category: Optional[str] = None, limit: int = 20) -> List[dict]:
+        """ Find the most recent articles matching keywords, a date range and a category
+        (see `PostgresPool.filter_articles`).
+        """
+        if self.pool is None:
+            raise RuntimeError("Filtering articles requires a database.")
+        key = ('filter', tuple(keywords), since, until, category, limit)
+        results = self.results.get(key)
+        if results is None:
+            results = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                self.pool.filter_articles, keywords, since, until, category, limit))
+            self.results.put(key, results)
+        return results
+
+    def _search_batch(self, queries: List[tuple]) -> List[List[Tuple[str, float]]]:
+        """ Answer a batch of (vector, k) queries with one Faiss call. Scores are cosine similarities. """
+        import numpy as np
+
+        index = self.index
+        k = min(max(k for _, k in queries), index.index.ntotal)
+        if k == 0:
+            return [[] for _ in queries]
+        # squared L2 distances of unit vectors: cos = 1 - d / 2
+        distances, indices = index.index.search(np.stack([vector for vector, _ in queries]).astype('float32'), k)
+        return [[(index.ids[position], float(1 - distance / 2))
+                 for distance, position in zip(distances[i, :query_k], indices[i, :query_k]) if position >= 0]
+                for i, (_, query_k) in enumerate(queries)]
+
+    def _embed_batch(self, texts: List[str]) -> list:
+        """ Embed a batch of query texts with one OpenAI request and normalize them. """
+        import numpy as np
+        from bot.openai import convert_texts_to_embeddings
+
+        vectors = np.asarray(convert_texts_to_embeddings(texts, self.api_key), dtype='float32')
+        return list(self.index.normalize_embeddings(vectors))
+
+    def _fetch_batch(self, id_lists: List[List[str]]) -> List[dict]:
+        """ Fetch the articles of a batch of ID lists with one database query. """
+        articles = self.pool.fetch_articles({id for ids in id_lists for id in ids})
+        return [{id: articles[id] for id in ids if id in articles} for ids in id_lists]
+
+    async def _with_articles(self, neighbours: List[Tuple[str, float]]) -> List[dict]:
+        """ Add the article details from the database (or the title from the index) to (id, score) pairs. """
+        articles = {}
+        if self.pool is not None and neighbours:
+            articles = await self.fetcher.submit([id for id, _ in neighbours])
+        results = []
+        for id, score in neighbours:
+            article = articles.get(id) or {'id': id, 'title': self.index.titles[self.index.positions[id]]}
+            results.append(dict(article, score=round(score, 4)))
+        return results
+
+
+def create_engine(index_dir: str, embedding_dim: int, use_database: bool = True, pool_size: int = 10,
+                  cache_size: int = DEFAULT_CACHE_SIZE, cache_ttl: float = DEFAULT_CACHE_TTL) -> SearchEngine:
+    """ Load the index and open the database pool of a search engine. """
+    from bot.embeddings import FaissDatabase
+
+    index = FaissDatabase.load(index_dir, embedding_dim)
+    pool = None
+    if use_database:
+        from bot.database import PostgresPool
+        pool = PostgresPool(maxconn=pool_size)
+    logging.info(f"Loaded an index of {len(index.ids)} articles from {index_dir}")
+    return SearchEngine(index, pool, cache_size=cache_size, cache_ttl=cache_ttl)
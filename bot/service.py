@@ -0,0 +1,143 @@
+""" A long-running HTTP query service over the article database and the vector index.
+
+The index and a pool of database connections are loaded once and kept in memory (see `bot.search.SearchEngine`).
+
+Usage:
+    python -m bot.service --port 8080 --index-dir faiss_db
+
+Endpoints (all return JSON):
+    GET  /similar/{arxiv_id}?k=10                 articles similar to an indexed article
+    GET  /search?q=portfolio+optimization&k=10    semantic search over the abstracts
+    GET  /articles?keyword=risk&since=2024-01-01&until=2024-02-01&category=q-fin.PM&limit=20
+    POST /reload                                  reload the index from disk (e.g. after update-index)
+    GET  /health, GET /metrics
+"""
+import os
+import time
+import asyncio
+import logging
+import argparse
+from typing import List, Optional
+
+from bot.metrics import REGISTRY, REQUEST_DURATION
+from bot.search import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, SearchEngine, create_engine
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+MAX_RESULTS = 100
+
+
+def create_app(engine: SearchEngine, index_dir: Optional[str] = None):
+    """ Create the aiohttp application of the service.
+    Args:
+        engine (SearchEngine): The engine that answers the queries.
+        index_dir (str): The directory `POST /reload` loads the index from.
+    Returns:
+        aiohttp.web.Application: The application.
+    """
+    from aiohttp import web
+
+    def bounded_int(request, name: str, default: int) -> int:
+        """ Read an integer query parameter between 1 and `MAX_RESULTS`. """
+        try:
+            value = int(request.query.get(name, default))
+        except ValueError:
+            raise web.HTTPBadRequest(text=f"'{name}' must be an integer.")
+        if not 1 <= value <= MAX_RESULTS:
+            raise web.HTTPBadRequest(text=f"'{name}' must be between 1 and {MAX_RESULTS}.")
+        return value
+
+    @web.middleware
+    async def timing(request, handler):
+        """ Record the duration of every request by route. """
+        start = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            route = request.match_info.route.resource
+            REQUEST_DURATION.observe(time.perf_counter() - start,
+                                     endpoint=route.canonical if route is not None else 'unknown')
+
+    async def similar(request):
+        try:
+            results = await engine.similar(request.match_info['arxiv_id'], bounded_int(request, 'k', 10))
+        except KeyError:
+            raise web.HTTPNotFound(text=f"{request.match_info['arxiv_id']} is not in the index.")
+        return web.json_response({'results': results})
+
+    async def search(request):
+        query = request.query.get('q', '').strip()
+        if not query:
+            raise web.HTTPBadRequest(text="The query parameter 'q' is required.")
+        return web.json_response({'results': await engine.search(query, bounded_int(request, 'k', 10))})
+
+    async def articles(request):
+        if engine.pool is None:
+            raise web.HTTPBadRequest(text="Filtering articles requires a database.")
+        results = await engine.filter(keywords=request.query.getall('keyword', []),
+                                      since=request.query.get('since'),
+                                      until=request.query.get('until'),
+                                      category=request.query.get('category'),
+                                      limit=bounded_int(request, 'limit', 20))
+        return web.json_response({'results': results})
+
+    async def reload(request):
+        from bot.embeddings import FaissDatabase
+
+        if index_dir is None:
+            raise web.HTTPBadRequest(text="The service was not started from an index directory.")
+        index = await asyncio.get_running_loop().run_in_executor(
+            None, FaissDatabase.load, index_dir, engine.index.embedding_dim)
+        engine.reload(index)
+        return web.json_response({'articles': len(index.ids)})
+
+    async def health(request):
+        return web.json_response({'status': 'ok', 'articles': len(engine.index.ids)})
+
+    async def metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+    app = web.Application(middlewares=[timing])
+    app.add_routes([
+        web.get('/similar/{arxiv_id}', similar),
+        web.get('/search', search),
+        web.get('/articles', articles),
+        web.post('/reload', reload),
+        web.get('/health', health),
+        web.get('/metrics', metrics),
+    ])
+    return app
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    from bot.embeddings import DEFAULT_EMBEDDING_DIM, DEFAULT_INDEX_DIR
+
+    parser = argparse.ArgumentParser(description='Serve similar-paper, semantic and filter queries over HTTP.')
+    parser.add_argument('--host', default=os.getenv('SERVICE_HOST', DEFAULT_HOST), help='The interface to listen on.')
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVICE_PORT', DEFAULT_PORT)), help='The port to listen on.')
+    parser.add_argument('--index-dir', default=os.getenv('FAISS_INDEX_DIR', DEFAULT_INDEX_DIR), help='Directory of index.faiss and metadata.pkl.')
+    parser.add_argument('--dim', type=int, default=DEFAULT_EMBEDDING_DIM, help='Embedding dimension.')
+    parser.add_argument('--no-database', action='store_true', help='Serve from the index only (no article details or filters).')
+    parser.add_argument('--pool-size', type=int, default=10, help='Maximum number of database connections.')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help='Number of cached results.')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL, help='Seconds a result stays cached.')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from aiohttp import web
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s')
+    args = parse_args(argv)
+    engine = create_engine(args.index_dir, args.dim, not args.no_database, args.pool_size, args.cache_size, args.cache_ttl)
+    try:
+        web.run_app(create_app(engine, args.index_dir), host=args.host, port=args.port)
+    finally:
+        if engine.pool is not None:
+            engine.pool.close()
+
+
+if __name__ == "__main__":
+    main()
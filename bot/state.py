@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_STATE_PATH = './state/bot_state.sqlite3'
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+# SQLite limits the number of host parameters per statement
+BATCH_SIZE = 500
+
+
+def encode(data) -> bytes:
+    """ Encode a value into compact JSON bytes. """
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def decode(payload: bytes):
+    """ Decode a value encoded with `encode`. """
+    return json.loads(payload)
+
+
+class StateStore:
+    """ A persistent store for the fetcher state, backed by SQLite in WAL mode.
+
+    Every entry is a row that is inserted or updated on its own, so reads and writes cost O(delta) no matter how many
+    entries are tracked, and every write is an atomic transaction (a crash never leaves a half-written state behind).
+    """
+    def __init__(self, filepath: Optional[str] = None):
+        """ Open (and create if needed) the state store.
+        Args:
+            filepath (str): Path to the SQLite file. Defaults to the `STATE_PATH` environment variable.
+        """
+        self.filepath = filepath or os.getenv('STATE_PATH', DEFAULT_STATE_PATH)
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.filepath)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                 id TEXT PRIMARY KEY,
+                                 category TEXT NOT NULL,
+                                 status TEXT NOT NULL,
+                                 payload BLOB NOT NULL,
+                                 updated_at REAL NOT NULL)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS signatures (
+                                 seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                 id TEXT UNIQUE NOT NULL,
+                                 signature BLOB NOT NULL)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                                 id TEXT PRIMARY KEY,
+                                 status TEXT NOT NULL,
+                                 chunks INTEGER NOT NULL,
+                                 bytes INTEGER NOT NULL,
+                                 updated_at REAL NOT NULL)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS posts (
+                                 id TEXT NOT NULL,
+                                 channel_id TEXT NOT NULL,
+                                 message_id INTEGER NOT NULL,
+                                 PRIMARY KEY (id, channel_id))""")
+        logging.info(f"State store opened at {self.filepath}")
+
+    def close(self) -> None:
+        """ Close the underlying SQLite connection. """
+        self.conn.close()
+
+    def record_entries(self, category: str, entries: Dict[str, dict]) -> List[str]:
+        """ Record entries found in a listing. Entries that are already tracked keep their status.
+        Args:
+            category (str): The listing the entries were found in.
+            entries (dict): Maps arXiv IDs to the entries parsed from the listing.
+        Returns:
+            list: IDs that were not tracked before.
+        """
+        known = self._existing(entries.keys())
+        new_ids = [id for id in entries if id not in known]
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO entries (id, category, status, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                  [(id, category, PENDING, encode(entries[id]), now) for id in new_ids])
+        logging.info(f"Recorded {len(new_ids)} new entries of {category}.")
+        return new_ids
+
+    def pending_ids(self, ids: Iterable[str]) -> List[str]:
+        """ Filter the IDs that have not been processed yet (unknown or not marked as done), keeping their order. """
+        ids = list(ids)
+        done = self._existing(ids, status=DONE)
+        return [id for id in ids if id not in done]
+
+    def failed_ids(self, ids: Iterable[str]) -> set:
+        """ Return the subset of IDs whose processing failed in an earlier run. """
+        return self._existing(ids, status=FAILED)
+
+    def mark_done(self, ids: Iterable[str]) -> None:
+        """ Mark entries as processed, so later runs skip them. """
+        self.set_status(ids, DONE)
+
+    def set_status(self, ids: Iterable[str], status: str) -> None:
+        """ Set the processing status of entries. """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("UPDATE entries SET status = ?, updated_at = ? WHERE id = ?",
+                                  [(status, now, id) for id in ids])
+
+    def load_entries(self, ids: Iterable[str]) -> Dict[str, dict]:
+        """ Load the stored entries with the given IDs. """
+        entries = {}
+        ids = list(ids)
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            rows = self.conn.execute(f"SELECT id, payload FROM entries WHERE id IN ({','.join('?' * len(batch))})", batch)
+            entries.update((id, decode(payload)) for id, payload in rows)
+        return entries
+
+    def save_signatures(self, signatures: Dict[str, bytes]) -> None:
+        """ Store the near-duplicate signatures of articles (see `bot.dedup`). """
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO signatures (id, signature) VALUES (?, ?)", signatures.items())
+
+    def load_signatures(self, limit: int) -> List[tuple]:
+        """ Load the `limit` most recently stored signatures as (id, signature) pairs, oldest first. """
+        rows = self.conn.execute("SELECT id, signature FROM signatures ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        return rows[::-1]
+
+    def count_signatures(self) -> int:
+        """ Return the number of stored signatures. """
+        return self.conn.execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+
+    def record_post(self, id: str, channel_id: str, message_id: int) -> None:
+        """ Remember the Telegram message an article was posted as, so that later posts can reply to it. """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO posts (id, channel_id, message_id) VALUES (?, ?, ?)",
+                              (id, channel_id, message_id))
+
+    def get_message_id(self, id: str, channel_id: str) -> Optional[int]:
+        """ Return the Telegram message an article was posted as in a channel, or None. """
+        row = self.conn.execute("SELECT message_id FROM posts WHERE id = ? AND channel_id = ?", (id, channel_id)).fetchone()
+        return row[0] if row else None
+
+    def record_documents(self, documents: Iterable[tuple]) -> None:
+        """ Record the outcome of PDF ingestion (see `bot.pdf`) as (id, status, chunks, bytes) tuples. """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO documents (id, status, chunks, bytes, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                  [(id, status, chunks, size, now) for id, status, chunks, size in documents])
+
+    def document_ids(self, statuses: Iterable[str] = (DONE,)) -> set:
+        """ Return the IDs of the documents whose ingestion ended with one of the given statuses. """
+        statuses = list(statuses)
+        rows = self.conn.execute(f"SELECT id FROM documents WHERE status IN ({','.join('?' * len(statuses))})", statuses)
+        return {row[0] for row in rows}
+
+    def import_json(self, filepath: str) -> None:
+        """ Import a state file written by `ArxivFetcher.save_to_json`.
+        Args:
+            filepath (str): Path to the JSON state file.
+        Example:
+            >>> StateStore().import_json('fetcher_state.json')
+        """
+        with open(filepath, 'r') as file:
+            data = json.load(file)
+        self.record_entries(data['category'], data.get('entries', {}))
+        logging.info(f"Imported fetcher state from {filepath}")
+
+    def _existing(self, ids: Iterable[str], status: Optional[str] = None) -> set:
+        """ Return the subset of IDs that are tracked (optionally with a given status). """
+        ids = list(ids)
+        existing = set()
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            query = f"SELECT id FROM entries WHERE id IN ({','.join('?' * len(batch))})"
+            params = list(batch)
+            if status is not None:
+                query += " AND status = ?"
+                params.append(status)
+            existing.update(row[0] for row in self.conn.execute(query, params))
+        return existing
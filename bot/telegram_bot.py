@@ -1,11 +1,10 @@
 import asyncio
-import requests
-import telegram
 import logging 
 
-from telegram import Bot
 from urllib.parse import quote
 
+from bot.resilience import request_timeout
+
 def get_messages_from_channel(token, limit=10) -> dict:
   """ Get messages from a channel in Telegram.
   Allows to get channel ID, title, and username (if there is at least one message in the channel).
@@ -16,10 +15,12 @@ def get_messages_from_channel(token, limit=10) -> dict:
   Returns:
     response (dict): JSON dictionary with response.
   """
+  import requests
+
   url = f"https://api.telegram.org/bot{token}/getUpdates?limit={limit}"
 
   try:
-    response = requests.get(url)
+    response = requests.get(url, timeout=request_timeout())
     response.raise_for_status()
 
     data = response.json()
@@ -51,12 +52,14 @@ def post_message_to_channel(token, channel_id, message):
     response (dict): JSON dictionary with the response.
 
   """
+  import requests
+
   url = f"https://api.telegram.org/bot{token}/sendMessage"
   data = {"chat_id": channel_id,
           "text": message
           }
   try:
-    response = requests.post(url, data=data)
+    response = requests.post(url, data=data, timeout=request_timeout())
     response.raise_for_status()
     return response.json()
 
@@ -66,5 +69,7 @@ def post_message_to_channel(token, channel_id, message):
   
 async def send_message_to_channel(token: str, channel_id: str, message:str):
   """ Async function to send a message to the specified Telegram channel """
+  from telegram import Bot
+
   bot = Bot(token=token)
   await bot.send_message(chat_id=channel_id, text=message, parse_mode='Markdown')
\ No newline at end of file
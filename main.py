@@ -4,11 +4,14 @@ import logging
 import argparse
 
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BlockingScheduler, BackgroundScheduler
 
+# heavy dependencies (APScheduler, psycopg2, OpenAI, Telegram, NumPy) are imported where they are first needed,
+# so that a run with nothing new to post stays cheap (see "Cold start" in the README)
 from bot.arxiv_api import ArxivFetcher
-from bot.post import TelegramPost
-from bot.database import PostgresHandler
+from bot.router import ChannelRouter, load_channel_profiles
+from bot.state import FAILED, StateStore
+from bot.dedup import REPLY, dedup_mode, load_deduplicator
+from bot.metrics import STAGE_ITEMS, stage, start_metrics_server, write_metrics
 
 LOG_PATH = './logs'
 os.makedirs(LOG_PATH, exist_ok=True)
@@ -24,64 +27,197 @@ logging.basicConfig(
 # load from .env file if present
 load_dotenv()
 
+# seconds to wait between two posts (Telegram limits the rate of messages per channel)
+POST_DELAY = 5
+
 def run_scheduler(scheduler_type: str) -> None:
     """ Run the main function from a scheduler (either blocking or background).
+
+    The job is driven by an `AnnouncementTrigger`: it polls densely around arXiv's daily announcement and backs off
+    otherwise. At most one run of `main` is active at a time and missed runs are coalesced into a single one.
     Args:
         scheduler_type (str): The type of scheduler to run. Can be 'block' or 'background'.
     Returns:
         None
     """
+    from apscheduler.schedulers.background import BlockingScheduler, BackgroundScheduler
+    from bot.scheduler import AnnouncementTrigger
+
+    if os.getenv('METRICS_PORT'):
+        start_metrics_server(int(os.getenv('METRICS_PORT')))
+
+    job_options = dict(trigger=AnnouncementTrigger(), max_instances=1, coalesce=True, misfire_grace_time=300)
+
     if scheduler_type == 'block':
         scheduler = BlockingScheduler()
-        job_id = scheduler.add_job(main, 'interval', seconds=30)
+        job_id = scheduler.add_job(main, **job_options)
         scheduler.start()
     elif scheduler_type == 'background':
         scheduler = BackgroundScheduler()
-        job_id = scheduler.add_job(main, 'interval', seconds=5)
+        job_id = scheduler.add_job(main, **job_options)
         scheduler.start()
-        time.sleep(60)
+        try:
+            while True:
+                time.sleep(60)
+        except (KeyboardInterrupt, SystemExit):
+            scheduler.shutdown()
     else:
         logging.error("Invalid scheduler type. Must be 'block' or 'background'.")
         raise Exception("Invalid scheduler type. Must be 'block' or 'background'.")
 
 def main():
+    db, store = None, None
     try:
-        fetcher = ArxivFetcher(category='q-fin.PM')
-        logging.info("Fetching recent arXiv updates...")
-        response = fetcher.fetch_updates()
-        logging.info("Parsing the response...")
-        entries = fetcher.parse_arxiv_response_re(response)
-
-        fetcher = ArxivFetcher.load_from_json('fetcher_state.json')
-        metadata = fetcher.fetch_metadata()
+        router = ChannelRouter(load_channel_profiles())
+        store = StateStore()
+
+        # each category is fetched once, however many channels follow it
+        entries, listed_in = {}, {}
+        for category in router.categories:
+            fetcher = ArxivFetcher(category=category)
+            logging.info(f"Fetching recent arXiv updates of {category}...")
+            # a category that cannot be fetched does not keep the others from being posted
+            try:
+                with stage('fetch_listing'):
+                    response = fetcher.fetch_updates()
+                logging.info("Parsing the response...")
+                with stage('parse'):
+                    parsed = fetcher.parse_arxiv_response_re(response)
+            except Exception as e:
+                logging.error(f"Failed to fetch the listing of {category}: {e}")
+                continue
+            STAGE_ITEMS.inc(len(parsed), stage='parse')
+            for id, entry in parsed.items():
+                entries.setdefault(id, entry)
+                listed_in.setdefault(id, set()).add(category)
+            fetcher.save_to_store(store)
+
+        # metadata of papers cross-listed in several categories is fetched once as well, and
+        # only for papers that have not been processed by an earlier run
+        fetcher.entries = entries
+        fetcher.ids = list(entries.keys())
+        if not fetcher.keep_pending(store):
+            logging.info("No new articles have been found.\n")
+            return
+
+        from bot.database import PostgresHandler
+        from bot.post import TelegramPost
 
         db = PostgresHandler()
-        
+        # guards against overlapping runs from other processes (e.g. cron jobs or several containers)
+        if not db.try_advisory_lock():
+            logging.info("Another run is already in progress. Skipping this one.\n")
+            return
+        # a concurrent run may have processed some of the articles in the meantime
+        if not fetcher.keep_pending(store):
+            logging.info("No new articles have been found.\n")
+            return
+        with stage('fetch_metadata'):
+            metadata = fetcher.fetch_metadata()
+        STAGE_ITEMS.inc(len(metadata), stage='fetch_metadata')
+
         # ## === embedding === ##
         # records = db.retrieve_rows(os.getenv('POSTGRES_TABLE'), n=2)
         # summary = records[0][2].replace("\n", " ")
         # embedding = convert_text_to_embedding(summary, os.getenv('OPENAI_TOKEN'))
         # ## === end of embedding === ##
 
-        metadata_selected = db.select_metadata(metadata)
+        with stage('db_check'):
+            metadata_selected = db.select_metadata(metadata) or []
 
-        if metadata_selected:
+        # articles that are already in the database need no further processing, unless an earlier run failed
+        # to post them
+        selected_ids = {item['id'] for item in metadata_selected}
+        selected_ids |= store.failed_ids(item['id'] for item in metadata)
+        metadata_selected = [item for item in metadata if item['id'] in selected_ids]
+        store.mark_done([item['id'] for item in metadata if item['id'] not in selected_ids])
 
+        if metadata_selected:
+            # new versions, cross-lists and near-identical preprints are not posted as new articles
+            mode = dedup_mode()
+            try:
+                deduplicator = load_deduplicator(store, db)
+                with stage('dedup'):
+                    duplicates = deduplicator.find_duplicates(metadata_selected) if deduplicator else {}
+                STAGE_ITEMS.inc(len(duplicates), stage='dedup')
+            except Exception as e:
+                # posting the articles unchecked could post duplicates, so they are retried by the next run instead
+                logging.error(f"Failed to check the articles for near-duplicates, they will be retried by the next run: {e}")
+                store.set_status([item['id'] for item in metadata_selected], FAILED)
+                STAGE_ITEMS.inc(len(metadata_selected), stage='failed')
+                metadata_selected, deduplicator, duplicates = [], None, {}
+
+            # the topic filters embed the articles: if that fails, the channels without topic filters are still served
+            # and the articles are retried by the next run for the others
+            topics_failed = False
+            with stage('route'):
+                try:
+                    routes = router.route(metadata_selected, listed_in)
+                except Exception as e:
+                    logging.error(f"Failed to apply the topic filters, posting to the channels without them only: {e}")
+                    routes = router.route(metadata_selected, listed_in, topics=False)
+                    topics_failed = True
+
+            # a failure only affects its own article: it is marked as failed and retried by the next run
             for item in metadata_selected:
-                  
-                logging.info(f"Inserting {item['id']} into the database...")
-                db.check_id_and_insert(item)
-                logging.info("Data inserted successfully.\n")
-
-                telegram_post = TelegramPost(item)
-                telegram_post.post_to_channel()
-                time.sleep(5)
-
-        db.close_connection()
+                try:
+                    logging.info(f"Inserting {item['id']} into the database...")
+                    with stage('db_insert'):
+                        db.check_id_and_insert(item)
+                    logging.info("Data inserted successfully.\n")
+
+                    original = duplicates.get(item['id'])
+                    if original is not None and mode != REPLY:
+                        logging.info(f"{item['id']} is a near-duplicate of {original}. Not posting it.")
+                        store.mark_done([item['id']])
+                        continue
+
+                    if not routes.get(item['id']) and not topics_failed:
+                        logging.info(f"{item['id']} does not match any channel.")
+                        if original is None and deduplicator:
+                            deduplicator.remember([item])
+                        store.mark_done([item['id']])
+                        continue
+
+                    # channels that already got the post in an earlier (failed) run are skipped
+                    profiles = [profile for profile in routes.get(item['id'], [])
+                                if store.get_message_id(item['id'], profile.channel_id) is None]
+                    if profiles:
+                        # the summary is computed once and fanned out to all matching channels
+                        with stage('summarize'):
+                            telegram_post = TelegramPost(item)
+                    for profile in profiles:
+                        # a near-duplicate is threaded below the original post if the channel has one
+                        reply_to = store.get_message_id(original, profile.channel_id) if original else None
+                        logging.info(f"Posting {item['id']} to {profile.channel_id}...")
+                        with stage('post'):
+                            message_id = telegram_post.post_to_channel(profile.channel_id, profile.hashtag, reply_to)
+                        if message_id is not None:
+                            store.record_post(item['id'], profile.channel_id, message_id)
+                        STAGE_ITEMS.inc(stage='post')
+                        time.sleep(POST_DELAY)
+                    if topics_failed:
+                        # the channels with topic filters are served by the next run
+                        store.set_status([item['id']], FAILED)
+                        continue
+                    if original is None and deduplicator:
+                        deduplicator.remember([item])
+                    store.mark_done([item['id']])
+                except Exception as e:
+                    logging.error(f"Failed to process {item['id']}, it will be retried by the next run: {e}")
+                    store.set_status([item['id']], FAILED)
+                    STAGE_ITEMS.inc(stage='failed')
 
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
 
+    finally:
+        if store is not None:
+            store.close()
+        if db is not None:
+            db.close_connection()
+        write_metrics()
+
 
 if __name__ == "__main__":
 